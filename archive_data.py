@@ -0,0 +1,84 @@
+import argparse
+import time
+from datetime import datetime, timedelta
+
+from flask_app import app, db, WaitingRoom, Message, CallSession, ArchivedConsultation, ArchivedMessage
+from sqlalchemy import func, insert, select
+
+# Moves completed/rejected consultations and read messages older than the
+# retention window (ARCHIVE_AFTER_DAYS) from the live tables into the archive
+# tables, which /history reads and /api/search indexes. Each batch is its own
+# short transaction (copy, then delete by id), so the app keeps writing while
+# this runs.
+#
+#   python archive_data.py                  # archive everything past the window
+#   python archive_data.py --days 90 --batch-size 1000 --pause 0.05
+#   python archive_data.py --dry-run        # only count what would move
+
+parser = argparse.ArgumentParser(description='Archive old consultations and messages')
+parser.add_argument('--days', type=int, help='retention window in days (default ARCHIVE_AFTER_DAYS)')
+parser.add_argument('--batch-size', type=int, help='rows per transaction (default ARCHIVE_BATCH_SIZE)')
+parser.add_argument('--pause', type=float, default=0, help='seconds to sleep between batches')
+parser.add_argument('--dry-run', action='store_true')
+parser.add_argument('--vacuum', action='store_true', help='VACUUM an SQLite database afterwards to return the freed pages')
+
+CONSULTATION_COLUMNS = ['id', 'patient_id', 'doctor_id', 'symptoms', 'status', 'created_at', 'end_time', 'feedback_submitted']
+MESSAGE_COLUMNS = ['id', 'sender_id', 'receiver_id', 'content', 'timestamp']
+
+
+def old_consultations(cutoff):
+    return WaitingRoom.query.filter(WaitingRoom.status.in_(['completed', 'rejected']), func.coalesce(WaitingRoom.end_time, WaitingRoom.created_at) < cutoff)
+
+
+def old_messages(cutoff):
+    return Message.query.filter(Message.read == True, Message.timestamp < cutoff)
+
+
+def archive_consultations(ids):
+    rows = select(*[getattr(WaitingRoom, name) for name in CONSULTATION_COLUMNS]).where(WaitingRoom.id.in_(ids))
+    db.session.execute(insert(ArchivedConsultation).from_select(CONSULTATION_COLUMNS, rows))
+    # Call records outlive the request they belonged to
+    CallSession.query.filter(CallSession.waiting_id.in_(ids)).update({CallSession.waiting_id: None}, synchronize_session=False)
+    WaitingRoom.query.filter(WaitingRoom.id.in_(ids)).delete(synchronize_session=False)
+
+
+def archive_messages(ids):
+    rows = select(*[getattr(Message, name) for name in MESSAGE_COLUMNS]).where(Message.id.in_(ids))
+    db.session.execute(insert(ArchivedMessage).from_select(MESSAGE_COLUMNS, rows))
+    Message.query.filter(Message.id.in_(ids)).delete(synchronize_session=False)
+
+
+def run(label, query, model, archive, batch_size, pause=0, dry_run=False):
+    # Walk the live table in id order; old rows have the lowest ids, so each
+    # batch reads only a little past the previous one
+    moved = last_id = 0
+    started = time.perf_counter()
+    while True:
+        ids = [row.id for row in query.with_entities(model.id).filter(model.id > last_id).order_by(model.id).limit(batch_size)]
+        if not ids:
+            break
+        last_id = ids[-1]
+        if not dry_run:
+            archive(ids)
+            db.session.commit()
+        moved += len(ids)
+        if pause:
+            time.sleep(pause)
+    print(f"{label:15} {moved:>9} {'would move' if dry_run else 'archived'} in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    with app.app_context():
+        db.create_all()
+        days = args.days if args.days is not None else app.config['ARCHIVE_AFTER_DAYS']
+        batch_size = args.batch_size or app.config['ARCHIVE_BATCH_SIZE']
+        cutoff = datetime.utcnow() - timedelta(days=days)
+        print(f"Archiving rows older than {cutoff:%Y-%m-%d %H:%M} ({days} days), {batch_size} per batch")
+        run('consultations', old_consultations(cutoff), WaitingRoom, archive_consultations, batch_size, args.pause, args.dry_run)
+        run('messages', old_messages(cutoff), Message, archive_messages, batch_size, args.pause, args.dry_run)
+        if args.vacuum and not args.dry_run and db.engine.dialect.name == 'sqlite':
+            db.session.close()
+            with db.engine.connect() as connection:
+                connection.exec_driver_sql('VACUUM')
+            print('Database vacuumed')
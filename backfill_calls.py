@@ -0,0 +1,8 @@
+from flask_app import app, db, backfill_call_sessions
+
+# Create call records for video calls started before CallSession existed,
+# from the "Videollamada iniciada" chat messages. Safe to run more than once.
+with app.app_context():
+    db.create_all()
+    created = backfill_call_sessions()
+    print(f"{created} call sessions backfilled")
@@ -0,0 +1,85 @@
+import argparse
+import multiprocessing
+import os
+import tempfile
+import time
+
+# Write throughput with several worker processes writing at once, the way
+# send_message and enter_waiting_room do under gunicorn. Compares SQLite's
+# default settings (SQLITE_TUNING=0) with the tuned pragmas from config.py,
+# or benchmarks a server database given with --url.
+#
+#   python bench_db_writes.py --workers 8 --writes 300
+#   python bench_db_writes.py --url postgresql+psycopg2://medicapp@localhost/medicapp_bench
+
+parser = argparse.ArgumentParser(description='Concurrent write throughput')
+parser.add_argument('--workers', type=int, default=8)
+parser.add_argument('--writes', type=int, default=300, help='writes per worker')
+parser.add_argument('--url', help='database URI to benchmark instead of the two SQLite setups')
+args = parser.parse_args()
+
+
+def worker(url, env, writes, start, results):
+    os.environ.update(env)
+    os.environ['DATABASE_URL'] = url
+    from flask_app import app, db, Message, queue_ordering
+    ok = errors = 0
+    with app.app_context():
+        start.wait()
+        for i in range(writes):
+            try:
+                # Alternate between the two hot write paths: a chat message and a
+                # queue admission (one INSERT ... SELECT)
+                if i % 2:
+                    db.session.add(Message(sender_id=1, receiver_id=2, content=f'Mensaje {i}'))
+                else:
+                    queue_ordering.admit(2, 1, 'Fiebre')
+                db.session.commit()
+                ok += 1
+            except Exception:
+                db.session.rollback()
+                errors += 1
+    results.put((ok, errors))
+
+
+def run(label, url, env):
+    os.environ.update(env)
+    os.environ['DATABASE_URL'] = url
+    setup = multiprocessing.Process(target=create_schema, args=(url, env))
+    setup.start()
+    setup.join()
+    start = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=worker, args=(url, env, args.writes, start, results)) for _ in range(args.workers)]
+    for process in processes:
+        process.start()
+    time.sleep(1)  # let every worker import the app before starting the clock
+    started = time.perf_counter()
+    start.set()
+    totals = [results.get() for _ in processes]
+    elapsed = time.perf_counter() - started
+    for process in processes:
+        process.join()
+    ok = sum(t[0] for t in totals)
+    errors = sum(t[1] for t in totals)
+    print(f"{label:28} {ok:>7} {errors:>7} {elapsed:>8.2f} {ok / elapsed:>10.1f}")
+
+
+def create_schema(url, env):
+    os.environ.update(env)
+    os.environ['DATABASE_URL'] = url
+    from flask_app import app, db
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+
+
+if __name__ == '__main__':
+    print(f"{args.workers} workers x {args.writes} writes")
+    print(f"{'setup':28} {'writes':>7} {'errors':>7} {'seconds':>8} {'writes/s':>10}")
+    if args.url:
+        run('server database', args.url, {})
+    else:
+        directory = tempfile.mkdtemp()
+        run('sqlite defaults', 'sqlite:///' + os.path.join(directory, 'default.db'), {'SQLITE_TUNING': '0'})
+        run('sqlite WAL + busy_timeout', 'sqlite:///' + os.path.join(directory, 'tuned.db'), {'SQLITE_TUNING': '1'})
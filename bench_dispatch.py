@@ -0,0 +1,153 @@
+import argparse
+import heapq
+import math
+import os
+import random
+import tempfile
+from collections import deque
+
+# Guardia wait times with patients picking their doctor by hand versus
+# automatic least-loaded dispatch (/enter_waiting_room/auto). A discrete-event
+# simulation on a virtual clock drives the real endpoints on a throwaway SQLite
+# database: patients arrive at random, each doctor sees their queue in order,
+# and every admission, call start and completion goes through the app, so the
+# dispatcher sees the same load it would in production. Both runs replay the
+# same arrivals, specialties and consultation lengths.
+#
+#   python bench_dispatch.py
+#   python bench_dispatch.py --doctors 20 --arrivals 5000 --utilization 0.9
+
+parser = argparse.ArgumentParser(description='Simulate manual choice vs automatic dispatch')
+parser.add_argument('--doctors', type=int, default=12)
+parser.add_argument('--arrivals', type=int, default=2000, help='patients per run')
+parser.add_argument('--utilization', type=float, default=0.85, help='offered load as a share of total doctor capacity')
+parser.add_argument('--consult-minutes', type=float, default=12, help='mean consultation length')
+parser.add_argument('--any-specialty', type=float, default=0.3, help='share of patients who do not ask for a specialty')
+parser.add_argument('--seed', type=int, default=1)
+args = parser.parse_args()
+
+if 'DATABASE_URL' not in os.environ:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_dispatch.db')
+
+from flask_app import app, db, User, WaitingRoom
+from werkzeug.security import generate_password_hash
+
+SPECIALTIES = ['Clínica', 'Pediatría', 'Cardiología', 'Dermatología']
+SPECIALTY_WEIGHTS = [0.5, 0.25, 0.15, 0.1]
+
+
+def seed(rng):
+    db.create_all()
+    password = generate_password_hash('bench', method='pbkdf2:sha256:1000')
+    doctors = []
+    for i in range(args.doctors):
+        specialty = SPECIALTIES[i] if i < len(SPECIALTIES) else rng.choices(SPECIALTIES, SPECIALTY_WEIGHTS)[0]
+        rating = rng.randint(3, 5)
+        doctors.append(User(username=f'dispatch_doc{i}', password=password, role='doctor', name=f'Doctor {i}',
+                            specialty=specialty, on_shift=True, rating_sum=rating, rating_count=1))
+    db.session.add_all(doctors)
+    patients = [User(username=f'dispatch_pac{i}', password=password, role='patient') for i in range(args.arrivals)]
+    db.session.add_all(patients)
+    db.session.commit()
+    return [(doctor.id, doctor.specialty, doctor.rating_sum) for doctor in doctors], [patient.id for patient in patients]
+
+
+def workload(rng, patients):
+    # (arrival minute, patient_id, specialty or '', consultation minutes)
+    rate = args.utilization * args.doctors / args.consult_minutes
+    now, arrivals = 0.0, []
+    for patient_id in patients:
+        now += rng.expovariate(rate)
+        specialty = '' if rng.random() < args.any_specialty else rng.choices(SPECIALTIES, SPECIALTY_WEIGHTS)[0]
+        arrivals.append((now, patient_id, specialty, rng.expovariate(1 / args.consult_minutes)))
+    return arrivals
+
+
+def manual_choice(rng, doctors, specialty):
+    # Patients scan the list and mostly go for the best-rated doctor of the
+    # specialty they need, whatever the length of the queue
+    candidates = [doctor for doctor in doctors if doctor[1] == specialty] or doctors
+    return rng.choices(candidates, [doctor[2] ** 4 for doctor in candidates])[0][0]
+
+
+def set_status(waiting_id, status):
+    with app.app_context():
+        WaitingRoom.query.get(waiting_id).status = status
+        db.session.commit()
+
+
+def simulate(client, doctors, arrivals, policy):
+    rng = random.Random(args.seed)
+    events = [(arrival[0], i, 'arrive', arrival) for i, arrival in enumerate(arrivals)]
+    heapq.heapify(events)
+    queues = {doctor[0]: deque() for doctor in doctors}
+    busy = dict.fromkeys(queues, False)
+    waits, served, seq = [], dict.fromkeys(queues, 0), len(events)
+
+    def start(now, doctor_id, waiting_id, arrived, minutes):
+        nonlocal seq
+        set_status(waiting_id, 'in_room')
+        waits.append(now - arrived)
+        served[doctor_id] += 1
+        busy[doctor_id] = True
+        seq += 1
+        heapq.heappush(events, (now + minutes, seq, 'finish', (doctor_id, waiting_id)))
+
+    while events:
+        now, _, kind, payload = heapq.heappop(events)
+        if kind == 'arrive':
+            _, patient_id, specialty, minutes = payload
+            with client.session_transaction() as session:
+                session['_user_id'] = str(patient_id)
+                session['_fresh'] = True
+            if policy == 'auto':
+                response = client.post('/enter_waiting_room/auto', data={'symptoms': 'Consulta de guardia', 'specialty': specialty})
+                doctor_id = response.get_json()['doctor_id']
+            else:
+                doctor_id = manual_choice(rng, doctors, specialty)
+                client.post(f'/enter_waiting_room/{doctor_id}', data={'symptoms': 'Consulta de guardia'})
+            with app.app_context():
+                waiting_id = WaitingRoom.query.filter_by(patient_id=patient_id, status='pending').one().id
+            if busy[doctor_id]:
+                queues[doctor_id].append((waiting_id, now, minutes))
+            else:
+                start(now, doctor_id, waiting_id, now, minutes)
+        else:
+            doctor_id, waiting_id = payload
+            set_status(waiting_id, 'completed')
+            busy[doctor_id] = False
+            if queues[doctor_id]:
+                start(now, doctor_id, *queues[doctor_id].popleft())
+    return waits, served
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+
+def report(label, waits, served):
+    stats = {
+        'mean': sum(waits) / len(waits),
+        'p50': percentile(waits, 50),
+        'p95': percentile(waits, 95),
+        'p99': percentile(waits, 99),
+        'max': max(waits),
+    }
+    counts = sorted(served.values())
+    print(f"{label:10} " + ' '.join(f"{value:>8.1f}" for value in stats.values()) + f"   {counts[0]:>4}-{counts[-1]:<4}")
+    return stats
+
+
+if __name__ == '__main__':
+    rng = random.Random(args.seed)
+    with app.app_context():
+        doctors, patients = seed(rng)
+    arrivals = workload(rng, patients)
+    client = app.test_client()
+    print(f"{args.doctors} doctors, {args.arrivals} patients, {args.utilization:.0%} utilization, "
+          f"{args.consult_minutes:g} min mean consultation")
+    print(f"{'wait (min)':10} {'mean':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'max':>8}   seen/doctor")
+    manual = report('manual', *simulate(client, doctors, arrivals, 'manual'))
+    auto = report('auto', *simulate(client, doctors, arrivals, 'auto'))
+    print(f"{'reduction':10} " + ' '.join(f"{1 - auto[key] / manual[key]:>8.0%}" if manual[key] else f"{'-':>8}" for key in manual))
@@ -0,0 +1,95 @@
+import argparse
+import os
+import resource
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# Export throughput and memory on a large history: seeds one doctor with
+# --rows chat messages (and a tenth as many consultations) on a throwaway
+# SQLite database, then streams each export through the /export endpoint and
+# reports rows/s, MB/s and how much the process RSS grew while streaming
+# (peak RSS, which also counts SQLite's page cache and memory-mapped pages).
+#
+#   python bench_export.py                    # 1,000,000 messages
+#   python bench_export.py --rows 200000 --formats ndjson
+
+parser = argparse.ArgumentParser(description='Benchmark streaming exports')
+parser.add_argument('--rows', type=int, default=1000000, help='messages to seed')
+parser.add_argument('--formats', nargs='+', default=['csv', 'ndjson'], choices=['csv', 'ndjson'])
+args = parser.parse_args()
+
+if 'DATABASE_URL' not in os.environ:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_export.db')
+
+from flask_app import app, db, User, Message, WaitingRoom
+from werkzeug.security import generate_password_hash
+
+PATIENTS = 200
+BATCH = 10000
+
+
+def rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def seed(rows):
+    db.create_all()
+    password = generate_password_hash('bench', method='pbkdf2:sha256:1000')
+    db.session.add(User(username='export_doc', password=password, role='doctor', name='Doctor Export'))
+    for i in range(PATIENTS):
+        db.session.add(User(username=f'export_pac{i}', password=password, role='patient', name=f'Paciente {i}'))
+    db.session.commit()
+    start = datetime.utcnow() - timedelta(days=365)
+    step = timedelta(days=365) / rows
+    # executemany in batches; the ORM unit of work would be far slower here
+    for offset in range(0, rows, BATCH):
+        db.session.execute(Message.__table__.insert(), [{
+            'sender_id': 1 if i % 2 else 2 + i % PATIENTS,
+            'receiver_id': 2 + i % PATIENTS if i % 2 else 1,
+            'content': f'Mensaje de prueba número {i}, con algo de texto para que la fila tenga un tamaño realista.',
+            'timestamp': start + step * i,
+            'read': True,
+        } for i in range(offset, min(offset + BATCH, rows))])
+        db.session.commit()
+    consultations = rows // 10
+    for offset in range(0, consultations, BATCH):
+        db.session.execute(WaitingRoom.__table__.insert(), [{
+            'patient_id': 2 + i % PATIENTS,
+            'doctor_id': 1,
+            'symptoms': 'Fiebre y dolor de cabeza',
+            'status': 'completed',
+            'created_at': start + step * i * 10,
+            'end_time': start + step * i * 10 + timedelta(minutes=20),
+            'queue_order': i,
+        } for i in range(offset, min(offset + BATCH, consultations))])
+        db.session.commit()
+    return consultations
+
+
+def run(client, kind, fmt, expected):
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    response = client.get(f'/export/{kind}.{fmt}', buffered=False)
+    size = lines = 0
+    for chunk in response.response:
+        size += len(chunk)
+        lines += chunk.count(b'\n')
+    elapsed = time.perf_counter() - started
+    response.close()
+    rows = lines - (1 if fmt == 'csv' else 0)
+    status = 'ok' if rows == expected else f'expected {expected}'
+    print(f"{kind:14} {fmt:7} {rows:>9} {elapsed:>8.2f} {rows / elapsed:>10.0f} {size / elapsed / 1e6:>7.1f} {rss_mb() - rss_before:>+9.1f}  {status}")
+
+
+if __name__ == '__main__':
+    started = time.perf_counter()
+    with app.app_context():
+        consultations = seed(args.rows)
+    print(f"Seeded {args.rows} messages and {consultations} consultations in {time.perf_counter() - started:.1f}s")
+    client = app.test_client()
+    client.post('/login', data={'username': 'export_doc', 'password': 'bench'})
+    print(f"{'export':14} {'format':7} {'rows':>9} {'seconds':>8} {'rows/s':>10} {'MB/s':>7} {'RSS MB':>9}")
+    for fmt in args.formats:
+        run(client, 'consultations', fmt, consultations)
+        run(client, 'messages', fmt, args.rows)
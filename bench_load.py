@@ -0,0 +1,202 @@
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+# Simulated telemedicine shift against the real Flask app on a throwaway SQLite
+# database. Patients sit in /guardias polling their queue position and unread
+# count, chat once accepted and complete their calls; doctors go on shift,
+# accept/reject, reorder their queue and start calls. Logins verify passwords
+# with the app's PASSWORD_HASH_METHOD at its full cost, as in production.
+#
+#   python bench_load.py --patients 100 --doctors 5 --duration 60
+#   python bench_load.py --save-baseline            # store results for later
+#   python bench_load.py --compare                  # diff against the baseline
+
+parser = argparse.ArgumentParser(description='Load test a simulated shift')
+parser.add_argument('--patients', type=int, default=50)
+parser.add_argument('--doctors', type=int, default=5)
+parser.add_argument('--duration', type=float, default=30, help='seconds of simulated shift')
+parser.add_argument('--poll-interval', type=float, default=3, help='seconds between patient polls, as in the pages')
+parser.add_argument('--seed', type=int, default=1)
+parser.add_argument('--baseline', default=os.path.join('bench_results', 'load_baseline.json'))
+parser.add_argument('--save-baseline', action='store_true')
+parser.add_argument('--compare', action='store_true')
+args = parser.parse_args()
+
+if 'DATABASE_URL' not in os.environ:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_load.db')
+
+from flask_app import app, db, User
+from werkzeug.security import generate_password_hash
+
+
+class Recorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def request(self, client, method, route, url, **kwargs):
+        started = time.perf_counter()
+        response = client.open(url, method=method, **kwargs)
+        elapsed = time.perf_counter() - started
+        with self._lock:
+            self.samples.setdefault(route, []).append(elapsed)
+            if response.status_code >= 500:
+                self.errors[route] = self.errors.get(route, 0) + 1
+        return response
+
+
+def percentile(values, pct):
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+
+def seed(patients, doctors):
+    db.create_all()
+    # One hash with the app's own method, shared by every account, so seeding
+    # stays fast and logins are not rehashed
+    password = generate_password_hash('bench', method=app.config['PASSWORD_HASH_METHOD'])
+    for i in range(doctors):
+        db.session.add(User(username=f'bench_doc{i}', password=password, role='doctor', name=f'Doctor {i}', specialty='General'))
+    for i in range(patients):
+        db.session.add(User(username=f'bench_pac{i}', password=password, role='patient', name=f'Paciente {i}'))
+    db.session.commit()
+    return [u.id for u in User.query.filter_by(role='doctor')]
+
+
+def login(recorder, username, deadline):
+    # A login turned away by the busy hashing pool (503) is retried after its
+    # Retry-After, as a user would; each attempt is counted
+    client = app.test_client()
+    while True:
+        response = recorder.request(client, 'POST', 'POST /login', '/login', data={'username': username, 'password': 'bench'})
+        if response.status_code != 503 or time.monotonic() >= deadline:
+            return client
+        time.sleep(float(response.headers.get('Retry-After', 1)))
+
+
+def patient_loop(recorder, index, doctor_ids, deadline, poll_interval, rng):
+    client = login(recorder, f'bench_pac{index}', deadline)
+    recorder.request(client, 'GET', 'GET /guardias', '/guardias')
+    # Stagger arrivals over the first part of the shift
+    time.sleep(rng.uniform(0, poll_interval))
+    recorder.request(client, 'POST', 'POST /enter_waiting_room', f'/enter_waiting_room/{rng.choice(doctor_ids)}', data={'symptoms': 'Fiebre y dolor de cabeza'})
+    last_message_id = 0
+    snapshot = {'consultations': []}
+    while time.monotonic() < deadline:
+        # One snapshot poll, as the pages' polling fallback does
+        response = recorder.request(client, 'GET', 'GET /api/snapshot', '/api/snapshot', headers={'If-None-Match': f'"{snapshot.get("version")}"'})
+        if response.status_code == 200:
+            snapshot = dict(response.get_json(), version=response.get_etag()[0])
+        for consultation in snapshot['consultations']:
+            doctor_id = consultation['other_user_id']
+            response = recorder.request(client, 'GET', 'GET /api/chat_messages', f'/api/chat_messages/{doctor_id}?since_id={last_message_id}')
+            if response.status_code == 200 and response.get_json():
+                last_message_id = response.get_json()[-1]['id']
+            if rng.random() < 0.3:
+                recorder.request(client, 'POST', 'POST /send_message', f'/send_message/{doctor_id}', data={'content': 'Sigo con fiebre'})
+            if consultation['status'] == 'in_room':
+                recorder.request(client, 'POST', 'POST /complete_call', f"/complete_call/{consultation['id']}")
+                recorder.request(client, 'POST', 'POST /submit_feedback', f"/submit_feedback/{consultation['id']}", data={'rating': str(rng.randint(3, 5))})
+                # Come back later with a new request
+                recorder.request(client, 'GET', 'GET /guardias', '/guardias')
+                recorder.request(client, 'POST', 'POST /enter_waiting_room', f'/enter_waiting_room/{rng.choice(doctor_ids)}', data={'symptoms': 'Control'})
+        time.sleep(poll_interval)
+
+
+def doctor_loop(recorder, index, deadline, poll_interval, rng):
+    client = login(recorder, f'bench_doc{index}', deadline)
+    recorder.request(client, 'POST', 'POST /toggle_shift', '/toggle_shift')
+    while time.monotonic() < deadline:
+        queue = recorder.request(client, 'GET', 'GET /api/waiting_requests', '/api/waiting_requests').get_json()
+        recorder.request(client, 'GET', 'GET /api/snapshot', '/api/snapshot')
+        pending = [w['id'] for w in queue['pending']]
+        accepted = queue['accepted']
+        if len(pending) > 2 and rng.random() < 0.2:
+            rng.shuffle(pending)
+            recorder.request(client, 'POST', 'POST /update_queue_order', '/update_queue_order', json={'order': pending})
+        if pending:
+            waiting_id = pending[0]
+            if rng.random() < 0.1:
+                recorder.request(client, 'POST', 'POST /reject_waiting', f'/reject_waiting/{waiting_id}')
+            else:
+                recorder.request(client, 'POST', 'POST /accept_waiting', f'/accept_waiting/{waiting_id}')
+                recorder.request(client, 'POST', 'POST /enable_chat', f'/enable_chat/{waiting_id}')
+        if len(accepted) > 1 and rng.random() < 0.3:
+            recorder.request(client, 'POST', 'POST /move_up', f"/move_up/{accepted[-1]['id']}")
+        waiting_call = [w for w in accepted if w['status'] == 'accepted']
+        if waiting_call:
+            recorder.request(client, 'GET', 'GET /waiting_requests', '/waiting_requests')
+            consultations = recorder.request(client, 'GET', 'GET /api/active_consultations', '/api/active_consultations').get_json()
+            patient_id = next(c['other_user_id'] for c in consultations if c['id'] == waiting_call[0]['id'])
+            recorder.request(client, 'POST', 'POST /send_message', f'/send_message/{patient_id}', data={'content': 'Hola, ya lo atiendo'})
+            recorder.request(client, 'POST', 'POST /start_video_call', f'/start_video_call/{patient_id}')
+        time.sleep(poll_interval)
+
+
+def report(recorder, elapsed):
+    results = {}
+    print(f"{'route':32} {'count':>7} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'5xx':>5}")
+    for route in sorted(recorder.samples):
+        values = sorted(recorder.samples[route])
+        results[route] = {
+            'count': len(values),
+            'rps': len(values) / elapsed,
+            'p50': percentile(values, 50) * 1000,
+            'p95': percentile(values, 95) * 1000,
+            'p99': percentile(values, 99) * 1000,
+            'errors': recorder.errors.get(route, 0),
+        }
+        r = results[route]
+        print(f"{route:32} {r['count']:>7} {r['rps']:>8.1f} {r['p50']:>8.1f} {r['p95']:>8.1f} {r['p99']:>8.1f} {r['errors']:>5}")
+    total = sum(r['count'] for r in results.values())
+    print(f"total: {total} requests in {elapsed:.1f}s ({total / elapsed:.1f} req/s)")
+    return results
+
+
+def compare(results, baseline):
+    print(f"\nagainst baseline ({baseline['meta']}):")
+    print(f"{'route':32} {'p50':>9} {'p95':>9} {'p99':>9} {'req/s':>9}")
+    for route, r in sorted(results.items()):
+        base = baseline['routes'].get(route)
+        if not base:
+            continue
+        deltas = [(r[k] - base[k]) / base[k] * 100 if base[k] else 0 for k in ('p50', 'p95', 'p99', 'rps')]
+        print(f"{route:32} " + ' '.join(f"{d:>+8.1f}%" for d in deltas))
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        doctor_ids = seed(args.patients, args.doctors)
+    recorder = Recorder()
+    started = time.monotonic()
+    deadline = started + args.duration
+    rng = random.Random(args.seed)
+    threads = [threading.Thread(target=doctor_loop, args=(recorder, i, deadline, args.poll_interval, random.Random(rng.random()))) for i in range(args.doctors)]
+    threads += [threading.Thread(target=patient_loop, args=(recorder, i, doctor_ids, deadline, args.poll_interval, random.Random(rng.random()))) for i in range(args.patients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    print(f"{args.patients} patients, {args.doctors} doctors, {args.duration:.0f}s shift, poll every {args.poll_interval}s, "
+          f"passwords hashed with {app.config['PASSWORD_HASH_METHOD']}")
+    results = report(recorder, elapsed)
+    meta = {'patients': args.patients, 'doctors': args.doctors, 'duration': args.duration, 'poll_interval': args.poll_interval,
+            'hash_method': app.config['PASSWORD_HASH_METHOD']}
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            sys.exit(f"No baseline at {args.baseline}; run with --save-baseline first")
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or '.', exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump({'meta': meta, 'routes': results}, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
@@ -0,0 +1,120 @@
+import argparse
+import math
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Login storm at shift change against polling latency. A fixed pool of
+# --server-threads stands in for the server's request workers; logins and
+# /api/snapshot polls arrive open-loop at fixed rates and are timed from
+# arrival to response, so time spent queued behind busy workers counts. The
+# same load runs with hashing inline on the request thread (the old behaviour)
+# and on the bounded hashing pool (PASSWORD_HASH_WORKERS / PASSWORD_HASH_QUEUE).
+#
+#   python bench_login.py
+#   python bench_login.py --login-rate 30 --poll-rate 50 --server-threads 16 --duration 20
+
+parser = argparse.ArgumentParser(description='Benchmark logins under mixed load')
+parser.add_argument('--duration', type=float, default=10, help='seconds of load per run')
+parser.add_argument('--login-rate', type=float, default=10, help='login attempts per second')
+parser.add_argument('--poll-rate', type=float, default=20, help='snapshot polls per second')
+parser.add_argument('--server-threads', type=int, default=8)
+parser.add_argument('--hash-workers', type=int, help='default PASSWORD_HASH_WORKERS')
+parser.add_argument('--hash-queue', type=int, help='default PASSWORD_HASH_QUEUE')
+parser.add_argument('--wrong-passwords', type=float, default=0.1, help='share of attempts with a bad password')
+parser.add_argument('--seed', type=int, default=1)
+args = parser.parse_args()
+
+if 'DATABASE_URL' not in os.environ:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_login.db')
+
+import flask_app
+from flask_app import app, db, User, PasswordHasher
+from werkzeug.security import generate_password_hash
+
+USERS = 500
+
+
+def seed():
+    db.create_all()
+    # One hash at the configured cost shared by every account, so seeding is quick
+    password = generate_password_hash('bench', method=app.config['PASSWORD_HASH_METHOD'])
+    db.session.add_all([User(username=f'login_user{i}', password=password, role='patient', name=f'Paciente {i}') for i in range(USERS)])
+    db.session.commit()
+    return User.query.filter_by(username='login_user0').one().id
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)] if values else float('nan')
+
+
+def run(label, workers, queue, poller_id):
+    app.config['PASSWORD_HASH_WORKERS'] = workers
+    app.config['PASSWORD_HASH_QUEUE'] = queue
+    flask_app.password_hasher = PasswordHasher()
+    flask_app.login_throttle = flask_app.LoginThrottle()
+    rng = random.Random(args.seed)
+    local = threading.local()
+    lock = threading.Lock()
+    results = {'login': [], 'poll': [], 'ok': 0, 'rejected': 0}
+
+    def login(arrived, username, password):
+        response = app.test_client().post('/login', data={'username': username, 'password': password})
+        with lock:
+            results['login'].append(time.perf_counter() - arrived)
+            if response.status_code == 302:
+                results['ok'] += 1
+            elif response.status_code in (429, 503):
+                results['rejected'] += 1
+
+    def poll(arrived):
+        if not hasattr(local, 'client'):
+            local.client = app.test_client()
+            with local.client.session_transaction() as session:
+                session['_user_id'] = str(poller_id)
+                session['_fresh'] = True
+        local.client.get('/api/snapshot')
+        with lock:
+            results['poll'].append(time.perf_counter() - arrived)
+
+    # Merge both Poisson arrival streams into one schedule
+    schedule = []
+    for kind, rate in (('login', args.login_rate), ('poll', args.poll_rate)):
+        at = 0.0
+        while rate and at < args.duration:
+            at += rng.expovariate(rate)
+            schedule.append((at, kind))
+    schedule.sort()
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.server_threads) as server:
+        for at, kind in schedule:
+            delay = started + at - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            arrived = started + at
+            if kind == 'login':
+                password = 'wrong' if rng.random() < args.wrong_passwords else 'bench'
+                server.submit(login, arrived, f'login_user{rng.randrange(USERS)}', password)
+            else:
+                server.submit(poll, arrived)
+    elapsed = time.perf_counter() - started
+    print(f"{label:22} {results['ok'] / elapsed:>9.1f} {results['rejected']:>9} "
+          f"{percentile(results['login'], 50) * 1000:>9.0f} {percentile(results['login'], 95) * 1000:>9.0f} "
+          f"{percentile(results['poll'], 50) * 1000:>9.0f} {percentile(results['poll'], 95) * 1000:>9.0f} {percentile(results['poll'], 99) * 1000:>9.0f}")
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        poller_id = seed()
+    workers = args.hash_workers if args.hash_workers is not None else app.config['PASSWORD_HASH_WORKERS']
+    queue = args.hash_queue if args.hash_queue is not None else app.config['PASSWORD_HASH_QUEUE']
+    print(f"{args.login_rate:g} logins/s and {args.poll_rate:g} polls/s for {args.duration:g}s on {args.server_threads} "
+          f"request threads, {app.config['PASSWORD_HASH_METHOD']}, {os.cpu_count()} CPUs")
+    print(f"{'hashing':22} {'logins/s':>9} {'rejected':>9} {'login p50':>9} {'p95':>9} {'poll p50':>9} {'p95':>9} {'p99':>9}  (ms)")
+    run('inline', 0, 0, poller_id)
+    run(f'pool {workers}+{queue} queued', workers, queue, poller_id)
@@ -0,0 +1,207 @@
+import argparse
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Query cost of the read routes as the data grows. A throwaway database is
+# grown with generate_dataset.py to each --scales fraction of the target
+# volumes. At each size every route is requested once through the app to
+# record the SQL it runs (as check_query_plans.py does), and that statement set
+# is replayed straight on a database connection --repeat times, so the timings
+# are the database's share of the request. The requests are made as the busiest
+# doctor on shift with an open chat, a patient in their queue and the patient
+# they are chatting with; a route that doesn't answer 200 stops the run. Routes
+# normally answer some lookups from in-process caches; --cold empties those
+# before recording, to time the cache-miss query sets instead. The last column
+# is how time grows with data: 0 is flat, 1 is linear.
+#
+#   python bench_queries.py
+#   python bench_queries.py --scales 0.01,0.1,1 --repeat 50
+#   python bench_queries.py --save-baseline            # store results for later
+#   python bench_queries.py --compare                  # diff against the baseline
+
+parser = argparse.ArgumentParser(description='Time route query sets at several data volumes')
+parser.add_argument('--scales', default='0.01,0.1,1', help='comma-separated fractions of the target volumes')
+parser.add_argument('--doctors', type=int, default=2000)
+parser.add_argument('--patients', type=int, default=200000)
+parser.add_argument('--consultations', type=int, default=400000)
+parser.add_argument('--messages', type=int, default=2000000)
+parser.add_argument('--repeat', type=int, default=20, help='replays per route and scale')
+parser.add_argument('--cold', action='store_true', help='record the queries of requests that miss the in-process caches')
+parser.add_argument('--seed', type=int, default=1)
+parser.add_argument('--baseline', default=os.path.join('bench_results', 'queries_baseline.json'))
+parser.add_argument('--save-baseline', action='store_true')
+parser.add_argument('--compare', action='store_true')
+args = parser.parse_args()
+
+if 'DATABASE_URL' not in os.environ:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_queries.db')
+
+import flask_app
+from flask_app import app, db, User, WaitingRoom, migrate_schema
+from generate_dataset import generate
+from sqlalchemy import event, func
+
+# (role, url) of the routes behind the pages and their polling
+ROUTES = [
+    ('patient', '/guardias'),
+    ('patient', '/api/doctors'),
+    ('patient', '/api/queue_position'),
+    ('patient', '/api/unread_count'),
+    ('patient', '/api/snapshot'),
+    ('chat_patient', '/api/chat_messages/{doctor}'),
+    ('doctor', '/waiting_requests'),
+    ('doctor', '/api/waiting_requests'),
+    ('doctor', '/api/active_consultations'),
+    ('doctor', '/api/unread_count'),
+    ('doctor', '/messages'),
+    ('doctor', '/chat/{chat_patient}'),
+    ('doctor', '/history'),
+    ('doctor', '/api/call_stats'),
+    ('doctor', '/api/search?q=fiebre'),
+]
+
+
+def pick_users():
+    # Among the on-shift doctors with a patient they can chat with, the one with
+    # the most consultations; that chat patient, and the patient at the back of
+    # the doctor's queue (the chat patient again if nobody is waiting)
+    chatting = db.session.query(WaitingRoom.doctor_id).filter(WaitingRoom.status.in_(['accepted', 'in_room']), WaitingRoom.chat_enabled == True)
+    doctor_id = db.session.query(WaitingRoom.doctor_id).join(User, User.id == WaitingRoom.doctor_id) \
+        .filter(User.on_shift == True, WaitingRoom.doctor_id.in_(chatting)) \
+        .group_by(WaitingRoom.doctor_id).order_by(func.count().desc()).limit(1).scalar()
+    if doctor_id is None:
+        sys.exit("No doctor on shift with an accepted, chat-enabled consultation; generate more doctors or a larger --scales")
+    chat_patient_id = db.session.query(WaitingRoom.patient_id).filter(WaitingRoom.doctor_id == doctor_id, WaitingRoom.status.in_(['accepted', 'in_room']),
+                                                                      WaitingRoom.chat_enabled == True).order_by(WaitingRoom.queue_order).limit(1).scalar()
+    patient_id = db.session.query(WaitingRoom.patient_id).filter_by(doctor_id=doctor_id, status='pending') \
+        .order_by(WaitingRoom.queue_order.desc()).limit(1).scalar()
+    return {'doctor': doctor_id, 'patient': patient_id or chat_patient_id, 'chat_patient': chat_patient_id}
+
+
+def drop_caches():
+    flask_app.user_cache = flask_app.UserCache()
+    flask_app.doctor_directory = flask_app.DoctorDirectory()
+    flask_app.queue_index = flask_app.QueueIndex()
+    flask_app.doctor_load = flask_app.DoctorLoad()
+
+
+def record(ids):
+    # Request each route and keep the statements it sends to the database
+    clients = {}
+    for role in ('doctor', 'patient', 'chat_patient'):
+        clients[role] = app.test_client()
+        with clients[role].session_transaction() as session:
+            session['_user_id'] = str(ids[role])
+            session['_fresh'] = True
+    statements, current = {}, [None]
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if current[0] and not executemany:
+            statements[current[0]].append((statement, parameters))
+
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        for role, url in ROUTES:
+            route = f'{role} {url}'
+            url = url.format(**ids)
+            if args.cold:
+                drop_caches()
+            else:
+                clients[role].get(url)  # warm up
+            statements[route], current[0] = [], route
+            response = clients[role].get(url)
+            current[0] = None
+            if response.status_code != 200:
+                # A redirect or error runs other queries than the route's own
+                sys.exit(f"{route} answered HTTP {response.status_code} for users {ids}; not timing it")
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return statements
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+
+def replay(statements):
+    # Writes made along the way (marking messages read) are rolled back, so
+    # every replay sees the same data
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        times = []
+        for _ in range(args.repeat):
+            started = time.perf_counter()
+            for statement, parameters in statements:
+                cursor.execute(statement, parameters)
+                if cursor.description:
+                    cursor.fetchall()
+            times.append(time.perf_counter() - started)
+            connection.rollback()
+    finally:
+        connection.close()
+    return {'queries': len(statements), 'p50': percentile(times, 50) * 1000, 'p95': percentile(times, 95) * 1000}
+
+
+def report(scales, results):
+    labels = [f'{scale:g}x' for scale in scales]
+    print(f"\n{'p50 ms':42} " + ' '.join(f"{label:>9}" for label in labels) + f" {'queries':>8} {'growth':>7}")
+    for route in results[labels[0]]:
+        timings = [results[label][route]['p50'] for label in labels]
+        queries = results[labels[-1]][route]['queries']
+        if len(scales) > 1 and queries and timings[0] > 0:
+            growth = f"{math.log(timings[-1] / timings[0]) / math.log(scales[-1] / scales[0]):>7.2f}"
+        else:
+            growth = f"{'-':>7}"  # nothing reaches the database
+        print(f"{route:42} " + ' '.join(f"{t:>9.3f}" for t in timings) + f" {queries:>8} {growth}")
+
+
+def compare(results, baseline, meta):
+    print(f"\nagainst baseline ({baseline['meta']}):")
+    if baseline['meta'] != meta:
+        print("(the baseline was taken with different volumes or settings)")
+    for label, routes in results.items():
+        base_routes = baseline['scales'].get(label, {})
+        for route, r in routes.items():
+            base = base_routes.get(route)
+            if base and base['p50']:
+                print(f"{label:>6} {route:42} p50 {r['p50']:>8.2f} ms ({(r['p50'] - base['p50']) / base['p50'] * 100:>+6.1f}%)")
+
+
+if __name__ == '__main__':
+    scales = sorted(float(scale) for scale in args.scales.split(','))
+    rng = random.Random(args.seed)
+    results = {}
+    with app.app_context():
+        migrate_schema()
+    for scale in scales:
+        label = f'{scale:g}x'
+        counts = [max(1, round(count * scale)) for count in (args.doctors, args.patients, args.consultations, args.messages)]
+        print(f"\n{label}: {counts[0]} doctors, {counts[1]} patients, {counts[2]} consultations, {counts[3]} messages")
+        with app.app_context():
+            generate(rng, *counts)
+            ids = pick_users()
+        statements = record(ids)
+        with app.app_context():
+            results[label] = {route: replay(route_statements) for route, route_statements in statements.items()}
+    report(scales, results)
+    meta = {'doctors': args.doctors, 'patients': args.patients, 'consultations': args.consultations, 'messages': args.messages,
+            'repeat': args.repeat, 'cold': args.cold}
+    if args.compare:
+        if not os.path.exists(args.baseline):
+            sys.exit(f"No baseline at {args.baseline}; run with --save-baseline first")
+        with open(args.baseline) as f:
+            compare(results, json.load(f), meta)
+    if args.save_baseline:
+        os.makedirs(os.path.dirname(args.baseline) or '.', exist_ok=True)
+        with open(args.baseline, 'w') as f:
+            json.dump({'meta': meta, 'scales': results}, f, indent=2)
+        print(f"Baseline saved to {args.baseline}")
@@ -0,0 +1,113 @@
+import argparse
+import math
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# /api/search latency at realistic volumes, against the LIKE '%...%' scan it
+# replaces. Seeds a throwaway SQLite database (the FTS triggers index every row
+# as it is inserted), then times each query as a doctor through the endpoint.
+#
+#   python bench_search.py
+#   python bench_search.py --messages 1000000 --consultations 200000 --repeat 50
+
+parser = argparse.ArgumentParser(description='Benchmark full-text search')
+parser.add_argument('--doctors', type=int, default=20)
+parser.add_argument('--patients', type=int, default=2000)
+parser.add_argument('--messages', type=int, default=300000)
+parser.add_argument('--consultations', type=int, default=60000)
+parser.add_argument('--records', type=int, default=20000, help='Patient records with medical history')
+parser.add_argument('--repeat', type=int, default=20, help='runs per query')
+parser.add_argument('--seed', type=int, default=1)
+args = parser.parse_args()
+
+if 'DATABASE_URL' not in os.environ:
+    os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench_search.db')
+
+from flask_app import app, db, User, Patient, Appointment, WaitingRoom, Message
+from werkzeug.security import generate_password_hash
+
+WORDS = ('dolor cabeza fiebre tos seca garganta mareo náuseas vómitos diarrea presión alta baja '
+         'asma alergia penicilina diabetes hipertensión migraña espalda rodilla fractura control '
+         'receta análisis sangre resultado estudio radiografía ecografía turno consulta síntomas '
+         'desde ayer semana días noche mañana mejor peor igual medicación ibuprofeno paracetamol').split()
+# Everyday filler around the clinical terms, so that each term matches a few
+# percent of rows as it would in real text rather than a quarter of them
+SYLLABLES = 'ba ca da fe ga lo ma ne pi ro sa te vi zu que tra pla cor men dis'.split()
+filler_rng = random.Random(args.seed)
+FILLER = [''.join(filler_rng.choice(SYLLABLES) for _ in range(filler_rng.randint(2, 4))) for _ in range(3000)]
+QUERIES = ['fiebre', 'dolor cabeza', 'penicilina', 'radiografía rodilla', 'ibupro', 'hipertension']
+BATCH = 10000
+
+
+def text(rng, words):
+    return ' '.join(rng.choice(WORDS) if rng.random() < 0.2 else rng.choice(FILLER) for _ in range(words)).capitalize()
+
+
+def insert_rows(table, count, make):
+    for offset in range(0, count, BATCH):
+        db.session.execute(table.insert(), [make(i) for i in range(offset, min(offset + BATCH, count))])
+        db.session.commit()
+
+
+def seed(rng):
+    db.create_all()
+    password = generate_password_hash('bench', method='pbkdf2:sha256:1000')
+    db.session.add_all([User(username=f'search_doc{i}', password=password, role='doctor', name=f'Doctor {i}') for i in range(args.doctors)])
+    db.session.add_all([User(username=f'search_pac{i}', password=password, role='patient', name=f'Paciente {i}') for i in range(args.patients)])
+    db.session.commit()
+    doctor = lambda: rng.randint(1, args.doctors)
+    patient = lambda: rng.randint(args.doctors + 1, args.doctors + args.patients)
+    start = datetime.utcnow() - timedelta(days=365)
+    insert_rows(Message.__table__, args.messages, lambda i: (lambda d, p: {
+        'sender_id': d if i % 2 else p, 'receiver_id': p if i % 2 else d, 'content': text(rng, rng.randint(4, 25)),
+        'timestamp': start + timedelta(seconds=i * 30), 'read': True})(doctor(), patient()))
+    insert_rows(WaitingRoom.__table__, args.consultations, lambda i: {
+        'patient_id': patient(), 'doctor_id': doctor(), 'symptoms': text(rng, rng.randint(3, 12)), 'status': 'completed',
+        'created_at': start + timedelta(minutes=i * 5), 'end_time': start + timedelta(minutes=i * 5 + 20), 'queue_order': i})
+    insert_rows(Patient.__table__, args.records, lambda i: {
+        'name': f'Historia {i}', 'age': rng.randint(1, 95), 'gender': rng.choice('FM'), 'medical_history': text(rng, rng.randint(10, 60))})
+    insert_rows(Appointment.__table__, args.records, lambda i: {
+        'patient_id': i + 1, 'doctor_id': doctor(), 'date': start + timedelta(hours=i), 'reason': 'Control'})
+
+
+def like_search(doctor_id, terms):
+    # What a naive implementation would run: every row of every source is scanned
+    rows = 0
+    for word in terms.split():
+        pattern = f'%{word}%'
+        rows += WaitingRoom.query.filter(WaitingRoom.doctor_id == doctor_id, WaitingRoom.symptoms.like(pattern)).count()
+        rows += Message.query.filter((Message.sender_id == doctor_id) | (Message.receiver_id == doctor_id), Message.content.like(pattern)).count()
+        rows += Patient.query.join(Appointment).filter(Appointment.doctor_id == doctor_id, Patient.medical_history.like(pattern)).count()
+    return rows
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[max(0, math.ceil(pct / 100 * len(values)) - 1)]
+
+
+if __name__ == '__main__':
+    rng = random.Random(args.seed)
+    started = time.perf_counter()
+    with app.app_context():
+        seed(rng)
+    print(f"Seeded {args.messages} messages, {args.consultations} consultations and {args.records} records in {time.perf_counter() - started:.1f}s")
+    client = app.test_client()
+    client.post('/login', data={'username': 'search_doc0', 'password': 'bench'})
+    print(f"{'query':22} {'results':>8} {'fts p50':>9} {'fts p95':>9} {'like p50':>9} {'speedup':>8}")
+    for terms in QUERIES:
+        fts, like = [], []
+        for _ in range(args.repeat):
+            t = time.perf_counter()
+            response = client.get('/api/search', query_string={'q': terms})
+            fts.append(time.perf_counter() - t)
+        for _ in range(max(1, args.repeat // 5)):
+            with app.app_context():
+                t = time.perf_counter()
+                like_search(1, terms)
+                like.append(time.perf_counter() - t)
+        results = len(response.get_json()['items'])
+        print(f"{terms:22} {results:>8} {percentile(fts, 50) * 1000:>8.1f}ms {percentile(fts, 95) * 1000:>8.1f}ms {percentile(like, 50) * 1000:>8.1f}ms {percentile(like, 50) / percentile(fts, 50):>7.1f}x")
@@ -0,0 +1,81 @@
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+try:
+    import brotli
+except ImportError:
+    brotli = None  # only .gz copies are written
+
+# Copies every file under static/ to static/dist with a content hash in its
+# name, writes .gz (and, with the brotli package installed, .br) copies of the
+# text files next to it and a manifest.json that asset_url() reads. Run it on
+# each deploy; pages then reference /assets/<name>.<hash>.<ext>, which browsers
+# cache for ASSET_MAX_AGE without revalidating.
+#
+#   python build_assets.py
+#   python build_assets.py --clean      # also delete builds no longer in the manifest
+
+parser = argparse.ArgumentParser(description='Fingerprint and precompress static assets')
+parser.add_argument('--clean', action='store_true', help='remove files from earlier builds')
+args = parser.parse_args()
+
+STATIC = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+DIST = os.path.join(STATIC, 'dist')
+COMPRESSIBLE = ('.css', '.js', '.json', '.svg', '.html', '.txt')
+
+
+def sources():
+    for root, dirs, files in os.walk(STATIC):
+        if root == STATIC and 'dist' in dirs:
+            dirs.remove('dist')
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            yield os.path.relpath(path, STATIC).replace(os.sep, '/'), path
+
+
+def write_compressed(path, data, suffix, compress):
+    # Only kept when it actually saves bytes
+    packed = compress(data)
+    if len(packed) < len(data):
+        with open(path + suffix, 'wb') as f:
+            f.write(packed)
+        return len(packed)
+    return None
+
+
+if __name__ == '__main__':
+    manifest, written = {}, set()
+    print(f"{'asset':40} {'bytes':>9} {'gzip':>9} {'brotli':>9}")
+    for name, path in sources():
+        with open(path, 'rb') as f:
+            data = f.read()
+        stem, ext = os.path.splitext(name)
+        fingerprinted = f'{stem}.{hashlib.sha256(data).hexdigest()[:12]}{ext}'
+        target = os.path.join(DIST, fingerprinted)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.copyfile(path, target)
+        written.add(target)
+        sizes = [None, None]
+        if ext in COMPRESSIBLE:
+            sizes[0] = write_compressed(target, data, '.gz', lambda raw: gzip.compress(raw, 9, mtime=0))
+            if brotli is not None:
+                sizes[1] = write_compressed(target, data, '.br', lambda raw: brotli.compress(raw, quality=11))
+            written.update(target + suffix for suffix, size in zip(('.gz', '.br'), sizes) if size)
+        manifest[name] = fingerprinted
+        print(f"{name:40} {len(data):>9} " + ' '.join(f"{size if size else '-':>9}" for size in sizes))
+    manifest_path = os.path.join(DIST, 'manifest.json')
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)  # running workers never see half a manifest
+    if args.clean:
+        for root, _, files in os.walk(DIST):
+            for name in files:
+                path = os.path.join(root, name)
+                if path not in written and path != manifest_path:
+                    os.remove(path)
+    if brotli is None:
+        print('brotli is not installed; only gzip copies were written')
+    print(f"{len(manifest)} assets written to {os.path.relpath(DIST)}")
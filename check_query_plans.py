@@ -0,0 +1,187 @@
+import os
+import re
+import sys
+import tempfile
+
+# Run against a throwaway database so the real one is never touched
+db_dir = tempfile.mkdtemp()
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(db_dir, 'plans.db')
+
+from datetime import datetime, timedelta
+from flask_app import app, db, User, Patient, Appointment, WaitingRoom, Message, Feedback
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+
+# Runs every route's queries and fails if SQLite plans any of them as a full
+# table (or full index) scan, or if a route answers with an error (its queries
+# would then not be the ones it runs when it works). test_query_plans.py runs
+# the same check under pytest. Usage: python check_query_plans.py [-v]
+
+# Full-text MATCH lookups show up as "SCAN <fts> VIRTUAL TABLE INDEX ..." but use the index
+SCAN = re.compile(r'^SCAN (TABLE )?(?!CONSTANT ROW)(\w+)\b(?! VIRTUAL TABLE INDEX)')
+
+# (role, method, url, form data) in the order a shift would exercise them
+ROUTES = [
+    ('patient', 'GET', '/guardias', None),
+    ('patient', 'GET', '/api/doctors?specialty=General', None),
+    ('patient', 'POST', '/enter_waiting_room/{doctor}', {'symptoms': 'Dolor de cabeza'}),
+    ('patient', 'POST', '/enter_waiting_room/auto', {'symptoms': 'Fiebre', 'specialty': 'General'}),
+    ('patient', 'GET', '/api/queue_position', None),
+    ('patient', 'GET', '/api/unread_count', None),
+    ('patient', 'GET', '/api/latest_unread_message', None),
+    ('patient', 'GET', '/api/active_consultations', None),
+    ('patient', 'GET', '/api/snapshot', None),
+    ('doctor', 'GET', '/waiting_requests', None),
+    ('doctor', 'GET', '/waiting_requests?history_before=2024-01-01T00:00:00_1', None),
+    ('doctor', 'GET', '/patients', None),
+    ('doctor', 'GET', '/patients?after=1', None),
+    ('doctor', 'GET', '/api/patients?after=1', None),
+    ('doctor', 'GET', '/appointments', None),
+    ('doctor', 'GET', '/appointments?after=2024-01-01T00:00:00_1', None),
+    ('doctor', 'GET', '/api/appointments?after=2024-01-01T00:00:00_1', None),
+    ('doctor', 'GET', '/api/waiting_requests', None),
+    ('doctor', 'POST', '/update_queue_order', {'json': {'order': [2, 1]}}),
+    ('doctor', 'POST', '/accept_waiting/{waiting}', None),
+    ('doctor', 'POST', '/move_up/{waiting}', None),
+    ('doctor', 'POST', '/move_down/{waiting}', None),
+    ('doctor', 'POST', '/enable_chat/{waiting}', None),
+    ('doctor', 'GET', '/api/active_consultations', None),
+    ('doctor', 'GET', '/api/snapshot', None),
+    ('doctor', 'GET', '/messages', None),
+    ('doctor', 'POST', '/send_message/{patient}', {'content': 'Hola'}),
+    ('patient', 'GET', '/messages', None),
+    ('patient', 'GET', '/chat/{doctor}', None),
+    ('doctor', 'GET', '/chat/{patient}', None),
+    ('patient', 'GET', '/api/chat_messages/{doctor}', None),
+    ('patient', 'GET', '/api/chat_messages/{doctor}?since_id=1', None),
+    ('patient', 'GET', '/api/chat_messages/{doctor}?before_id=5', None),
+    ('doctor', 'POST', '/start_video_call/{patient}', None),
+    ('patient', 'POST', '/complete_call/{waiting}', None),
+    ('doctor', 'GET', '/api/call_stats', None),
+    ('patient', 'POST', '/submit_feedback/{waiting}', {'rating': '5'}),
+    ('doctor', 'POST', '/reject_waiting/{other_waiting}', None),
+    ('doctor', 'GET', '/history', None),
+    ('doctor', 'GET', '/history?before=2024-01-01T00:00:00_1', None),
+    ('patient', 'GET', '/history', None),
+    ('patient', 'GET', '/history/chat/{doctor}', None),
+    ('patient', 'GET', '/history/chat/{doctor}?before=5', None),
+    ('doctor', 'GET', '/export/consultations.csv?from=2024-01-01&to=2030-01-01', None),
+    ('doctor', 'GET', '/export/feedback.ndjson', None),
+    ('doctor', 'GET', '/export/messages.ndjson?from=2024-01-01', None),
+    ('doctor', 'GET', '/api/search?q=dolor', None),
+    ('doctor', 'GET', '/api/search?q=mensaje&kind=messages&page=2', None),
+    ('doctor', 'POST', '/toggle_shift', None),
+]
+
+
+def seed():
+    db.create_all()
+    doctor = User(username='plan_doc', password=generate_password_hash('plan_doc'), role='doctor', name='Plan Doctor', on_shift=True)
+    patient = User(username='plan_pac', password=generate_password_hash('plan_pac'), role='patient', name='Plan Paciente')
+    other = User(username='plan_otro', password=generate_password_hash('plan_otro'), role='patient', name='Otro Paciente')
+    db.session.add_all([doctor, patient, other])
+    db.session.commit()
+    other_waiting = WaitingRoom(patient_id=other.id, doctor_id=doctor.id, symptoms='Fiebre', queue_order=1)
+    db.session.add(other_waiting)
+    for i in range(10):
+        db.session.add(Message(sender_id=doctor.id if i % 2 else patient.id, receiver_id=patient.id if i % 2 else doctor.id, content=f'Mensaje {i}'))
+    db.session.add(Feedback(from_user_id=other.id, to_user_id=doctor.id, rating=4))
+    db.session.add(WaitingRoom(patient_id=other.id, doctor_id=doctor.id, symptoms='Tos', status='completed', end_time=datetime.utcnow() - timedelta(days=3)))
+    record = Patient(name='Plan Paciente', age=40, gender='F')
+    db.session.add(record)
+    db.session.flush()
+    db.session.add(Appointment(patient_id=record.id, doctor_id=doctor.id, date=datetime.utcnow(), reason='Control'))
+    db.session.commit()
+    return {'doctor': doctor.id, 'patient': patient.id, 'other_waiting': other_waiting.id}
+
+
+def capture_statements(ids):
+    # Returns the statements each route ran and the routes that didn't answer 2xx/3xx
+    statements, errors = [], []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if current_route[0] and not executemany and statement.lstrip().upper().startswith(('SELECT', 'INSERT', 'UPDATE', 'DELETE')):
+            statements.append((current_route[0], statement, parameters))
+
+    current_route = [None]
+    with app.app_context():
+        engine = db.engine
+    event.listen(engine, 'before_cursor_execute', before_cursor_execute)
+    clients = {}
+    for role, username in [('doctor', 'plan_doc'), ('patient', 'plan_pac')]:
+        current_route[0] = f'POST /login ({role})'
+        clients[role] = app.test_client()
+        response = clients[role].post('/login', data={'username': username, 'password': username})
+        if response.status_code >= 400:
+            errors.append((current_route[0], response.status_code))
+    for role, method, url, data in ROUTES:
+        # Look up ids created by earlier routes without recording those queries
+        current_route[0] = None
+        if '{waiting}' in url and 'waiting' not in ids:
+            with app.app_context():
+                ids['waiting'] = WaitingRoom.query.filter_by(patient_id=ids['patient']).first().id
+        url = url.format(**ids)
+        current_route[0] = f'{method} {url} ({role})'
+        if method == 'GET':
+            response = clients[role].get(url)
+        elif data and 'json' in data:
+            response = clients[role].post(url, json=data['json'])
+        else:
+            response = clients[role].post(url, data=data)
+        if response.status_code >= 400:
+            errors.append((current_route[0], response.status_code))
+        response.close()  # ends a streamed export's request context in order
+    event.remove(engine, 'before_cursor_execute', before_cursor_execute)
+    return statements, errors
+
+
+def is_bounded_read(statement, plan):
+    # The first page of a keyset-paginated list reads in index order and stops
+    # at the LIMIT, so its SCAN touches at most one page of rows
+    sql = ' '.join(statement.upper().split())
+    return ' WHERE ' not in sql and ' ORDER BY ' in sql and ' LIMIT ' in sql and not any('TEMP B-TREE' in detail for detail in plan)
+
+
+def explain(statements, verbose=False):
+    failures = []
+    connection = db.engine.raw_connection()
+    try:
+        cursor = connection.cursor()
+        seen = set()
+        for route, statement, parameters in statements:
+            if (route, statement) in seen:
+                continue
+            seen.add((route, statement))
+            cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+            plan = [row[-1] for row in cursor.fetchall()]
+            scans = [detail for detail in plan if SCAN.match(detail)]
+            if is_bounded_read(statement, plan):
+                scans = []
+            if scans:
+                failures.append((route, statement, plan))
+            if verbose or scans:
+                print(f"{'FAIL' if scans else 'ok  '} {route}")
+                print('     ' + ' '.join(statement.split()))
+                for detail in plan:
+                    print('       ' + detail)
+    finally:
+        connection.close()
+    return failures
+
+
+def check(verbose=False):
+    # Requests must run outside an app context so each one gets its own `g`
+    with app.app_context():
+        ids = seed()
+    statements, errors = capture_statements(ids)
+    with app.app_context():
+        failures = explain(statements, verbose)
+    return statements, errors, failures
+
+
+if __name__ == '__main__':
+    statements, errors, failures = check('-v' in sys.argv)
+    for route, status in errors:
+        print(f"FAIL {route} answered HTTP {status}")
+    print(f"{len(statements)} statements checked, {len(failures)} with table scans, {len(errors)} routes failed")
+    sys.exit(1 if failures or errors else 0)
@@ -0,0 +1,21 @@
+import os
+import tempfile
+
+import pytest
+
+# The tests run against a throwaway database, set before flask_app is imported
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'tests.db')
+
+
+@pytest.fixture
+def fresh_db():
+    # An empty schema and empty in-process caches, so no test sees another's rows
+    import flask_app
+    with flask_app.app.app_context():
+        flask_app.db.drop_all()
+        flask_app.db.create_all()
+    flask_app.user_cache = flask_app.UserCache()
+    flask_app.doctor_directory = flask_app.DoctorDirectory()
+    flask_app.queue_index = flask_app.QueueIndex()
+    flask_app.doctor_load = flask_app.DoctorLoad()
+    return flask_app.db
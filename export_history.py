@@ -0,0 +1,36 @@
+import argparse
+import sys
+
+from flask_app import app, User, EXPORT_COLUMNS, export_rows, export_stream, parse_export_date
+
+# Streams a doctor's consultations, feedback or chats to a file or stdout, the
+# same export as /export/<kind>.<format>, for auditors and scheduled jobs.
+#
+#   python export_history.py dr_perez consultations --format csv --from 2024-01-01 --to 2024-06-30 -o consultas.csv
+#   python export_history.py dr_perez messages --format ndjson | gzip > mensajes.ndjson.gz
+
+parser = argparse.ArgumentParser(description="Export a doctor's history")
+parser.add_argument('doctor', help='doctor username')
+parser.add_argument('kind', choices=sorted(EXPORT_COLUMNS))
+parser.add_argument('--format', choices=['csv', 'ndjson'], default='csv')
+parser.add_argument('--from', dest='start', help='first day, YYYY-MM-DD')
+parser.add_argument('--to', dest='end', help='last day, YYYY-MM-DD')
+parser.add_argument('-o', '--output', help='file to write (default stdout)')
+args = parser.parse_args()
+
+if __name__ == '__main__':
+    with app.app_context():
+        doctor = User.query.filter_by(username=args.doctor, role='doctor').first()
+        if not doctor:
+            sys.exit(f"No doctor named {args.doctor}")
+        try:
+            start, end = parse_export_date(args.start), parse_export_date(args.end, end=True)
+        except ValueError:
+            sys.exit('Dates must be YYYY-MM-DD')
+        out = open(args.output, 'w', newline='', encoding='utf-8') if args.output else sys.stdout
+        try:
+            for chunk in export_stream(args.kind, args.format, export_rows(args.kind, doctor.id, start, end)):
+                out.write(chunk)
+        finally:
+            if args.output:
+                out.close()
@@ -1,17 +1,54 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, Response, stream_with_context, g, has_request_context, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.utils import safe_join
 from datetime import datetime, timedelta
-from sqlalchemy import func
+from sqlalchemy import func, event, tuple_, case, insert, update, delete, select, literal
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateIndex, CreateTable
+from sqlalchemy.orm import selectinload, make_transient_to_detached, aliased
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from bisect import bisect_left, insort
+import csv
+import gzip
+import hashlib
+import heapq
+import io
+import json
+import mimetypes
 import os
+import threading
+import time
+from config import Config, engine_options
+try:
+    import redis
+except ImportError:
+    redis = None  # the doctor directory is then cached per process only
 
 app = Flask(__name__)
-app.config['SECRET_KEY'] = 'your-secret-key'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///medicapp.db'
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config.from_object(Config)
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config)
 
 db = SQLAlchemy(app)
+
+def configure_sqlite(engine):
+    @event.listens_for(engine, 'connect')
+    def _set_sqlite_pragmas(dbapi_connection, connection_record):
+        # WAL lets readers run alongside the single writer; busy_timeout makes
+        # writers wait for the lock instead of failing with "database is locked"
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={app.config['SQLITE_JOURNAL_MODE']}")
+        cursor.execute(f"PRAGMA synchronous={app.config['SQLITE_SYNCHRONOUS']}")
+        cursor.execute(f"PRAGMA busy_timeout={app.config['SQLITE_BUSY_TIMEOUT_MS']}")
+        cursor.execute(f"PRAGMA mmap_size={app.config['SQLITE_MMAP_SIZE']}")
+        cursor.close()
+
+with app.app_context():
+    if db.engine.dialect.name == 'sqlite' and app.config['SQLITE_TUNING']:
+        configure_sqlite(db.engine)
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
@@ -25,6 +62,16 @@ class User(UserMixin, db.Model):
     description = db.Column(db.Text, nullable=True)
     specialty = db.Column(db.String(100), nullable=True)  # Only for doctors
     on_shift = db.Column(db.Boolean, default=False)  # For doctors
+    # Running feedback totals, kept up to date by submit_feedback (doctors only)
+    rating_sum = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    rating_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    __table_args__ = (
+        db.Index('ix_user_role_on_shift', 'role', 'on_shift'),  # on-shift doctor list
+    )
+
+    @property
+    def avg_rating(self):
+        return round(self.rating_sum / self.rating_count, 1) if self.rating_count else 0
 
 class Patient(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -41,6 +88,10 @@ class Appointment(db.Model):
     reason = db.Column(db.Text, nullable=True)
     patient = db.relationship('Patient', backref=db.backref('appointments', lazy=True))
     doctor = db.relationship('User', backref=db.backref('appointments', lazy=True))
+    __table_args__ = (
+        db.Index('ix_appointment_date', 'date'),  # keyset pagination by (date, id)
+        db.Index('ix_appointment_doctor_patient', 'doctor_id', 'patient_id'),  # a doctor's patients, for search
+    )
 
 class WaitingRoom(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -55,6 +106,19 @@ class WaitingRoom(db.Model):
     chat_enabled = db.Column(db.Boolean, default=False)
     patient = db.relationship('User', foreign_keys=[patient_id], backref=db.backref('patient_waiting_rooms', lazy=True))
     doctor = db.relationship('User', foreign_keys=[doctor_id], backref=db.backref('doctor_waiting_rooms', lazy=True))
+    __table_args__ = (
+        db.Index('ix_waiting_room_doctor_status_order', 'doctor_id', 'status', 'queue_order'),  # doctor queues
+        db.Index('ix_waiting_room_doctor_status_end', 'doctor_id', 'status', 'end_time'),  # consultation history
+        db.Index('ix_waiting_room_patient_status', 'patient_id', 'status'),  # patient's own requests
+        db.Index('ix_waiting_room_status', 'status'),  # queue index rebuilds
+        # One slot per key in each of a doctor's two queues
+        db.Index('ux_waiting_room_pending_order', 'doctor_id', 'queue_order', unique=True,
+                 sqlite_where=db.text("status = 'pending'"), postgresql_where=db.text("status = 'pending'")),
+        db.Index('ux_waiting_room_active_order', 'doctor_id', 'queue_order', unique=True,
+                 sqlite_where=db.text("status IN ('accepted', 'in_room')"), postgresql_where=db.text("status IN ('accepted', 'in_room')")),
+        # Archived rows keep their ids, so SQLite must never hand out the id of a deleted row again
+        {'sqlite_autoincrement': True},
+    )
 
 class Message(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -65,6 +129,11 @@ class Message(db.Model):
     read = db.Column(db.Boolean, default=False)
     sender = db.relationship('User', foreign_keys=[sender_id], backref=db.backref('sent_messages', lazy=True))
     receiver = db.relationship('User', foreign_keys=[receiver_id], backref=db.backref('received_messages', lazy=True))
+    __table_args__ = (
+        db.Index('ix_message_receiver_read_timestamp', 'receiver_id', 'read', 'timestamp'),  # unread counts
+        db.Index('ix_message_sender_receiver', 'sender_id', 'receiver_id'),  # chat history between two users
+        {'sqlite_autoincrement': True},  # ids are kept by the archive, see WaitingRoom
+    )
 
 class Feedback(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -75,10 +144,1090 @@ class Feedback(db.Model):
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     from_user = db.relationship('User', foreign_keys=[from_user_id], backref=db.backref('given_feedbacks', lazy=True))
     to_user = db.relationship('User', foreign_keys=[to_user_id], backref=db.backref('received_feedbacks', lazy=True))
+    __table_args__ = (
+        db.Index('ix_feedback_to_user', 'to_user_id'),  # doctor ratings
+    )
+
+class CallSession(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    waiting_id = db.Column(db.Integer, db.ForeignKey('waiting_room.id'), nullable=True)  # None for backfilled calls with no request
+    doctor_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    room_name = db.Column(db.String(100), nullable=False)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow, nullable=False)
+    ended_at = db.Column(db.DateTime, nullable=True)
+    duration_seconds = db.Column(db.Integer, nullable=True)
+    waiting = db.relationship('WaitingRoom', backref=db.backref('calls', lazy=True))
+    __table_args__ = (
+        db.Index('ix_call_session_pair_started', 'doctor_id', 'patient_id', 'started_at'),  # recent call between two users
+        db.Index('ix_call_session_doctor_started', 'doctor_id', 'started_at'),  # call stats
+        db.Index('ix_call_session_waiting', 'waiting_id'),  # calls of a consultation
+    )
+
+    def finish(self, when):
+        self.ended_at = when
+        self.duration_seconds = int((when - self.started_at).total_seconds())
+
+class ArchivedConsultation(db.Model):
+    # Completed and rejected WaitingRoom rows moved out of the live table by
+    # archive_data.py, keeping their ids
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    doctor_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    symptoms = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    created_at = db.Column(db.DateTime)
+    end_time = db.Column(db.DateTime)
+    feedback_submitted = db.Column(db.Boolean, default=False)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    patient = db.relationship('User', foreign_keys=[patient_id])
+    doctor = db.relationship('User', foreign_keys=[doctor_id])
+    __table_args__ = (
+        db.Index('ix_archived_consultation_doctor_end', 'doctor_id', 'status', 'end_time'),  # history pages
+        db.Index('ix_archived_consultation_patient_end', 'patient_id', 'status', 'end_time'),
+    )
+
+class ArchivedMessage(db.Model):
+    # Read messages older than the retention window, moved out by archive_data.py
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    timestamp = db.Column(db.DateTime)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_archived_message_sender_receiver', 'sender_id', 'receiver_id', 'id'),  # archived conversations
+        db.Index('ix_archived_message_receiver', 'receiver_id'),  # exports
+    )
+
+class Notification(db.Model):
+    # Outbox: patient notifications written in the same transaction as the
+    # change they announce, then moved to Message by the delivery worker
+    id = db.Column(db.Integer, primary_key=True)
+    sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    content = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+class SchemaMigration(db.Model):
+    # One row per schema migration applied by migrate_schema()
+    version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    name = db.Column(db.String(100), nullable=False)
+    applied_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+# Full-text search (SQLite FTS5): one external-content index per searchable
+# column, kept in sync by triggers, so the text is stored only once. Rows that
+# belong to users also index an `owner` column of 'u<id>' tokens, read through
+# a view, so a doctor's search is narrowed inside the index instead of checking
+# every match against the table. The archive tables have indexes of their own,
+# so rows moved there by archive_data.py stay searchable.
+SEARCH_SOURCES = {
+    'symptoms': ('waiting_room', 'symptoms', ('doctor_id',)),
+    'messages': ('message', 'content', ('sender_id', 'receiver_id')),
+    'history': ('patient', 'medical_history', ()),
+    'archived_symptoms': ('archived_consultation', 'symptoms', ('doctor_id',)),
+    'archived_messages': ('archived_message', 'content', ('sender_id', 'receiver_id')),
+}
+
+def search_index_ddl(table, column, owners):
+    fts = f'{table}_fts'
+    owner = lambda row: " || ' ' || ".join(f"'u' || {row}.{name}" for name in owners)
+    columns, new, old, watched = column, f'new.{column}', f'old.{column}', column
+    statements = []
+    if owners:
+        statements.append(f"CREATE VIEW IF NOT EXISTS {table}_search AS SELECT id, {column}, {owner(table)} AS owner FROM {table}")
+        columns, new, old = f'{column}, owner', f'{new}, {owner("new")}', f'{old}, {owner("old")}'
+        watched = ', '.join((column,) + owners)
+    content = f'{table}_search' if owners else table
+    return statements + [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({columns}, content='{content}', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ai AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_ad AFTER DELETE ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ('delete', old.id, {old}); END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_au AFTER UPDATE OF {watched} ON {table} BEGIN "
+        f"INSERT INTO {fts}({fts}, rowid, {columns}) VALUES ('delete', old.id, {old}); "
+        f"INSERT INTO {fts}(rowid, {columns}) VALUES (new.id, {new}); END",
+    ]
+
+@event.listens_for(db.metadata, 'after_create')
+def _create_search_index(target, connection, **kw):
+    if connection.dialect.name != 'sqlite':
+        return
+    for table, column, owners in SEARCH_SOURCES.values():
+        exists = connection.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = ?", (f'{table}_fts',)).first()
+        for statement in search_index_ddl(table, column, owners):
+            connection.exec_driver_sql(statement)
+        if not exists:
+            # Index rows that were there before the search index
+            connection.exec_driver_sql(f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')")
+
+@event.listens_for(db.metadata, 'before_drop')
+def _drop_search_index(target, connection, **kw):
+    if connection.dialect.name == 'sqlite':
+        for table, _, _ in SEARCH_SOURCES.values():
+            connection.exec_driver_sql(f'DROP TABLE IF EXISTS {table}_fts')
+            connection.exec_driver_sql(f'DROP VIEW IF EXISTS {table}_search')
+
+def rebuild_search_index():
+    # Re-read every indexed column from its table, then merge the index b-trees
+    for table, _, _ in SEARCH_SOURCES.values():
+        fts = f'{table}_fts'
+        db.session.execute(db.text(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')"))
+        db.session.execute(db.text(f"INSERT INTO {fts}({fts}) VALUES ('optimize')"))
+    db.session.commit()
+
+def call_room_name(user_id, other_id):
+    return f"medicapp-{min(user_id, other_id)}-{max(user_id, other_id)}"
+
+class LiveEvents:
+    # Per-key change counters. Keys are ('user', id) for a user's inbox and
+    # consultations and ('queue', doctor_id) for a doctor's pending queue.
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._versions = {}
+
+    def publish(self, keys):
+        if not keys:
+            return
+        with self._cond:
+            for key in keys:
+                self._versions[key] = self._versions.get(key, 0) + 1
+            self._cond.notify_all()
+
+    def _snapshot(self, keys):
+        return tuple(self._versions.get(key, 0) for key in keys)
+
+    def version(self, keys):
+        with self._cond:
+            return self._snapshot(keys)
+
+    def wait(self, keys, seen, timeout):
+        with self._cond:
+            self._cond.wait_for(lambda: self._snapshot(keys) != seen, timeout)
+            return self._snapshot(keys)
+
+live_events = LiveEvents()
+
+class LiveIndex:
+    # Base of the per-process indexes mirrored from waiting_room. Subclasses
+    # read rows with _rows(doctor_ids), install them with _install(rows,
+    # doctor_ids) and apply committed changes with _apply(changes); doctor_ids
+    # is None for a full rebuild. Changes committed while rows are being read
+    # are applied again after the install, so a read can't undo them. Other
+    # worker processes' changes are picked up by re-reading a doctor's entries
+    # once they are QUEUE_REFRESH_INTERVAL old, and by a full rebuild every
+    # QUEUE_INDEX_MAX_AGE seconds.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stale = set()  # doctor_ids whose entries must be re-read
+        self._loaded_at = {}  # doctor_id -> when its entries were last re-read
+        self._built_at = None
+        self._reading = 0
+        self._recorded = []  # changes applied while a read is in progress
+
+    def _read(self, doctor_ids=None):
+        with self._lock:
+            self._reading += 1
+            start = len(self._recorded)
+        try:
+            started = time.monotonic()
+            rows = self._rows(doctor_ids)
+            with self._lock:
+                self._install(rows, doctor_ids)
+                if doctor_ids is None:
+                    self._built_at, self._loaded_at = started, {}
+                else:
+                    self._loaded_at.update(dict.fromkeys(doctor_ids, started))
+                for changes in self._recorded[start:]:
+                    self._apply(changes)
+        finally:
+            with self._lock:
+                self._reading -= 1
+                if not self._reading:
+                    self._recorded = []
+
+    def rebuild(self):
+        with self._lock:
+            self._stale = set()
+        self._read()
+
+    def reload(self, doctor_ids):
+        self._read(set(doctor_ids))
+
+    def apply(self, changes):
+        # changes: waiting_id -> (doctor_id, patient_id, queue_order, status), or None if deleted
+        with self._lock:
+            if self._reading:
+                self._recorded.append(changes)
+            if self._built_at is not None:
+                self._apply(changes)
+
+    def mark_stale(self, doctor_id):
+        # A set-based UPDATE rewrote this doctor's queue; re-read it on next use
+        with self._lock:
+            self._stale.add(doctor_id)
+
+    def _ensure_fresh(self):
+        if self._built_at is None or time.monotonic() - self._built_at > app.config['QUEUE_INDEX_MAX_AGE']:
+            self.rebuild()
+            return
+        with self._lock:
+            stale, self._stale = self._stale, set()
+        if stale:
+            self.reload(stale)
+
+    def _refresh(self, doctor_id):
+        # Re-read one doctor's entries if other workers may have changed them
+        # since; returns whether it did
+        loaded_at = max(self._built_at or 0, self._loaded_at.get(doctor_id, 0))
+        if time.monotonic() - loaded_at <= app.config['QUEUE_REFRESH_INTERVAL']:
+            return False
+        self.reload([doctor_id])
+        return True
+
+class QueueIndex(LiveIndex):
+    # Pending requests per doctor, kept sorted by (queue_order, id), so a
+    # patient's position is a bisect instead of a COUNT over the queue.
+    def __init__(self):
+        super().__init__()
+        self._queues = {}  # doctor_id -> sorted [(queue_order, waiting_id)]
+        self._entries = {}  # waiting_id -> (doctor_id, patient_id, queue_order)
+        self._patients = {}  # patient_id -> set of pending waiting_ids
+
+    def _rows(self, doctor_ids):
+        query = db.session.query(WaitingRoom.id, WaitingRoom.doctor_id, WaitingRoom.patient_id, WaitingRoom.queue_order).filter(WaitingRoom.status == 'pending')
+        if doctor_ids is not None:
+            query = query.filter(WaitingRoom.doctor_id.in_(doctor_ids))
+        return query.all()
+
+    def _install(self, rows, doctor_ids):
+        if doctor_ids is None:
+            self._queues, self._entries, self._patients = {}, {}, {}
+        else:
+            for doctor_id in doctor_ids:
+                for _, waiting_id in list(self._queues.get(doctor_id, ())):
+                    self._remove(waiting_id)
+        for waiting_id, doctor_id, patient_id, queue_order in rows:
+            self._add(waiting_id, doctor_id, patient_id, queue_order or 0)
+
+    def _add(self, waiting_id, doctor_id, patient_id, queue_order):
+        insort(self._queues.setdefault(doctor_id, []), (queue_order, waiting_id))
+        self._entries[waiting_id] = (doctor_id, patient_id, queue_order)
+        self._patients.setdefault(patient_id, set()).add(waiting_id)
+
+    def _remove(self, waiting_id):
+        entry = self._entries.pop(waiting_id, None)
+        if entry:
+            doctor_id, patient_id, queue_order = entry
+            queue = self._queues[doctor_id]
+            del queue[bisect_left(queue, (queue_order, waiting_id))]
+            self._patients[patient_id].discard(waiting_id)
+
+    def _apply(self, changes):
+        for waiting_id, row in changes.items():
+            self._remove(waiting_id)
+            if row and row[3] == 'pending':
+                self._add(waiting_id, row[0], row[1], row[2] or 0)
+
+    def _first_pending(self, patient_id):
+        with self._lock:
+            pending = [(self._entries[w][2], w) for w in self._patients.get(patient_id, ())]
+            if not pending:
+                return None
+            queue_order, waiting_id = min(pending)
+            doctor_id = self._entries[waiting_id][0]
+            return waiting_id, doctor_id, bisect_left(self._queues[doctor_id], (queue_order, waiting_id)) + 1
+
+    def position(self, patient_id):
+        # Returns (waiting_id, doctor_id, position) for the patient's first pending request
+        self._ensure_fresh()
+        queued = self._first_pending(patient_id)
+        if queued is None:
+            # Not queued as far as this process knows; another worker may have admitted them
+            row = db.session.query(WaitingRoom.doctor_id).filter(WaitingRoom.patient_id == patient_id, WaitingRoom.status == 'pending').order_by(WaitingRoom.queue_order, WaitingRoom.id).first()
+            if row is None:
+                return None
+            self.reload([row.doctor_id])
+        elif not self._refresh(queued[1]):
+            return queued
+        return self._first_pending(patient_id)
+
+queue_index = QueueIndex()
+
+def specialty_key(specialty):
+    return (specialty or '').strip().lower()
+
+class DoctorLoad(LiveIndex):
+    # Open requests (pending, accepted, in_room) per doctor, plus heaps of the
+    # on-shift doctors by (load, doctor_id), one per specialty and one for all
+    # of them, so dispatch takes the least-loaded doctor without counting
+    # queues. Heap entries are never updated in place: a load change pushes a
+    # new entry, and entries that no longer match a doctor's load are dropped
+    # when they reach the top.
+    STATUSES = ('pending', 'accepted', 'in_room')
+
+    def __init__(self):
+        super().__init__()
+        self._load = {}  # doctor_id -> open requests
+        self._open = {}  # waiting_id -> doctor_id
+        self._specialties = {}  # on-shift doctor_id -> specialty_key
+        self._heaps = {}  # specialty_key -> [(load, doctor_id)]
+        self._all = []
+        self._directory_version = None
+
+    def _rows(self, doctor_ids):
+        query = db.session.query(WaitingRoom.id, WaitingRoom.doctor_id).filter(WaitingRoom.status.in_(self.STATUSES))
+        if doctor_ids is not None:
+            query = query.filter(WaitingRoom.doctor_id.in_(doctor_ids))
+        return query.all()
+
+    def _install(self, rows, doctor_ids):
+        if doctor_ids is None:
+            load = {}
+            for _, doctor_id in rows:
+                load[doctor_id] = load.get(doctor_id, 0) + 1
+            self._load, self._open = load, dict(rows)
+            self._heapify()
+            return
+        self._open = {waiting_id: doctor_id for waiting_id, doctor_id in self._open.items() if doctor_id not in doctor_ids}
+        load = dict.fromkeys(doctor_ids, 0)
+        for waiting_id, doctor_id in rows:
+            self._open[waiting_id] = doctor_id
+            load[doctor_id] += 1
+        for doctor_id, count in load.items():
+            self._set_load(doctor_id, count)
+
+    def _heapify(self):
+        self._heaps, self._all = {}, []
+        for doctor_id, specialty in self._specialties.items():
+            entry = (self._load.get(doctor_id, 0), doctor_id)
+            self._heaps.setdefault(specialty, []).append(entry)
+            self._all.append(entry)
+        for heap in self._heaps.values():
+            heapq.heapify(heap)
+        heapq.heapify(self._all)
+
+    def _set_load(self, doctor_id, load):
+        self._load[doctor_id] = load
+        if doctor_id in self._specialties:
+            heapq.heappush(self._heaps[self._specialties[doctor_id]], (load, doctor_id))
+            heapq.heappush(self._all, (load, doctor_id))
+            if len(self._all) > 4 * len(self._specialties) + 64:
+                self._heapify()  # too many outdated entries
+
+    def _apply(self, changes):
+        # Same changes as QueueIndex
+        for waiting_id, row in changes.items():
+            doctor_id = self._open.pop(waiting_id, None)
+            if doctor_id is not None:
+                self._set_load(doctor_id, self._load[doctor_id] - 1)
+            if row and row[3] in self.STATUSES:
+                self._open[waiting_id] = row[0]
+                self._set_load(row[0], self._load.get(row[0], 0) + 1)
+
+    def _sync_doctors(self):
+        # On-shift doctors come from the directory, which is invalidated on
+        # every shift or profile change
+        doctors, version = doctor_directory.get()
+        if version != self._directory_version:
+            with self._lock:
+                self._specialties = {doctor['id']: specialty_key(doctor['specialty']) for doctor in doctors}
+                self._directory_version = version
+                self._heapify()
+
+    def _least_loaded(self, heap):
+        while heap:
+            load, doctor_id = heap[0]
+            if doctor_id in self._specialties and self._load.get(doctor_id, 0) == load:
+                return doctor_id
+            heapq.heappop(heap)
+        return None
+
+    def pick(self, specialty=None):
+        # The least-loaded on-shift doctor of the given specialty, or of any
+        # specialty if none of those is on shift; None if nobody is
+        self._sync_doctors()
+        self._ensure_fresh()
+        key = specialty_key(specialty)
+        checked = set()
+        while True:
+            with self._lock:
+                doctor_id = self._least_loaded(self._heaps[key]) if key and key in self._heaps else None
+                if doctor_id is None:
+                    doctor_id = self._least_loaded(self._all)
+            # Confirm the winner's load unless it was read moments ago
+            if doctor_id is None or doctor_id in checked or not self._refresh(doctor_id):
+                return doctor_id
+            checked.add(doctor_id)
+
+doctor_load = DoctorLoad()
+
+def touch_live(session, *keys):
+    # Mark keys as changed; they are published once the session commits
+    session.info.setdefault('live_keys', set()).update(keys)
+
+@event.listens_for(db.session, 'after_flush')
+def _collect_live_keys(session, flush_context):
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Message):
+            touch_live(session, ('user', obj.receiver_id))
+        elif isinstance(obj, WaitingRoom):
+            touch_live(session, ('user', obj.patient_id), ('user', obj.doctor_id), ('queue', obj.doctor_id))
+            row = None if obj in session.deleted else (obj.doctor_id, obj.patient_id, obj.queue_order, obj.status)
+            session.info.setdefault('queue_changes', {})[obj.id] = row
+        elif isinstance(obj, Notification) and obj in session.new:
+            session.info['outbox'] = True
+
+def touch_queue(session, doctor_id):
+    # For set-based UPDATEs of a doctor's queue, which bypass the flush hook
+    session.info.setdefault('queue_reload', set()).add(doctor_id)
+    touch_live(session, ('queue', doctor_id), ('user', doctor_id))
+
+@event.listens_for(db.session, 'after_commit')
+def _publish_live_keys(session):
+    queue_changes = session.info.pop('queue_changes', None)
+    if queue_changes:
+        queue_index.apply(queue_changes)
+        doctor_load.apply(queue_changes)
+    for doctor_id in session.info.pop('queue_reload', ()):
+        queue_index.mark_stale(doctor_id)
+        doctor_load.mark_stale(doctor_id)
+    if session.info.pop('outbox', False):
+        notification_outbox.wake()
+    live_events.publish(session.info.pop('live_keys', None))
+
+@event.listens_for(db.session, 'after_rollback')
+def _discard_live_keys(session):
+    session.info.pop('live_keys', None)
+    session.info.pop('queue_changes', None)
+    session.info.pop('queue_reload', None)
+    session.info.pop('outbox', None)
+
+PENDING = ('pending',)
+ACTIVE = ('accepted', 'in_room')
+
+class QueueOrdering:
+    # Sparse queue_order keys. A new entry goes QUEUE_ORDER_GAP after the tail
+    # and a move takes the midpoint between its new neighbours, so both touch a
+    # single row; a full reorder is one CASE UPDATE. When neighbours get too
+    # close the queue is renumbered by a background thread.
+    #
+    # Keys are unique per doctor and queue (ux_waiting_room_*_order). Slots are
+    # taken with a single INSERT ... SELECT / UPDATE that reads the tail itself,
+    # and bulk rewrites only move rows into key ranges nothing else occupies, so
+    # no statement ever collides with a row it has not moved yet.
+    ATTEMPTS = 3
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._scheduled = set()  # (doctor_id, statuses) waiting for renumbering
+        self._wakeup = threading.Event()
+        self._worker = None
+
+    def _queue(self, doctor_id, statuses):
+        return WaitingRoom.query.filter(WaitingRoom.doctor_id == doctor_id, WaitingRoom.status.in_(statuses))
+
+    def _tail(self, doctor_id, statuses):
+        tail = aliased(WaitingRoom)
+        return select(func.coalesce(func.max(tail.queue_order), 0) + app.config['QUEUE_ORDER_GAP']).where(tail.doctor_id == doctor_id, tail.status.in_(statuses))
+
+    def _commit_slot(self, statement, doctor_id, patient_id, extra=()):
+        # Another worker may take the same tail key between our read and write on
+        # databases that don't serialize writers; the unique index turns that
+        # into an IntegrityError and we simply try again. Rows in extra are
+        # committed in the same transaction.
+        for attempt in range(self.ATTEMPTS):
+            try:
+                result = db.session.execute(statement)
+                if result.rowcount == 0:
+                    db.session.rollback()
+                    return 0
+                db.session.add_all(extra)
+                touch_queue(db.session, doctor_id)
+                touch_live(db.session, ('user', patient_id))
+                db.session.commit()
+                return result.rowcount
+            except IntegrityError:
+                db.session.rollback()
+                if attempt == self.ATTEMPTS - 1:
+                    raise
+
+    def admit(self, patient_id, doctor_id, symptoms):
+        tail = self._tail(doctor_id, PENDING).add_columns(literal(patient_id), literal(doctor_id), literal(symptoms), literal('pending'))
+        statement = insert(WaitingRoom).from_select(['queue_order', 'patient_id', 'doctor_id', 'symptoms', 'status'], tail)
+        self._commit_slot(statement, doctor_id, patient_id)
+
+    def accept(self, waiting_id, doctor_id, patient_id, extra=()):
+        # Returns False if the request was no longer pending
+        statement = update(WaitingRoom).where(WaitingRoom.id == waiting_id, WaitingRoom.doctor_id == doctor_id, WaitingRoom.status == 'pending').values(
+            status='accepted', queue_order=self._tail(doctor_id, ACTIVE).scalar_subquery()).execution_options(synchronize_session=False)
+        return self._commit_slot(statement, doctor_id, patient_id, extra) == 1
+
+    def move(self, waiting, statuses, up):
+        # Moves waiting one place up or down; returns False at the end of the queue
+        for attempt in range(2):
+            mine = tuple_(WaitingRoom.queue_order, WaitingRoom.id)
+            if up:
+                neighbours = self._queue(waiting.doctor_id, statuses).filter(mine < tuple_(waiting.queue_order, waiting.id)).order_by(WaitingRoom.queue_order.desc(), WaitingRoom.id.desc())
+            else:
+                neighbours = self._queue(waiting.doctor_id, statuses).filter(mine > tuple_(waiting.queue_order, waiting.id)).order_by(WaitingRoom.queue_order, WaitingRoom.id)
+            keys = [row.queue_order for row in neighbours.with_entities(WaitingRoom.queue_order).limit(2)]
+            if not keys:
+                return False
+            gap = app.config['QUEUE_ORDER_GAP']
+            beyond = keys[1] if len(keys) > 1 else keys[0] + (-gap if up else gap)
+            low, high = sorted((keys[0], beyond))
+            if high - low >= 2:
+                waiting.queue_order = (low + high) // 2
+                if min(waiting.queue_order - low, high - waiting.queue_order) < app.config['QUEUE_ORDER_MIN_GAP']:
+                    self.schedule_renumber(waiting.doctor_id, statuses)
+                return True
+            # No integer left between the neighbours: renumber now and retry
+            self.renumber(waiting.doctor_id, statuses)
+            db.session.refresh(waiting)
+        return False
+
+    def _assign(self, doctor_id, statuses, keys, base=0):
+        # keys: waiting_id -> new queue_order (plus base, a SQL expression), in one UPDATE
+        if keys:
+            self._queue(doctor_id, statuses).filter(WaitingRoom.id.in_(keys)).update(
+                {WaitingRoom.queue_order: base + case(keys, value=WaitingRoom.id)}, synchronize_session=False)
+            touch_queue(db.session, doctor_id)
+
+    def reorder(self, doctor_id, ordered_ids, statuses=PENDING):
+        # The listed rows move, in order, to fresh keys after the current tail;
+        # the tail is read by the UPDATE itself so an admission can't slip in
+        gap = app.config['QUEUE_ORDER_GAP']
+        self._assign(doctor_id, statuses, {waiting_id: index * gap for index, waiting_id in enumerate(ordered_ids)},
+                     base=self._tail(doctor_id, statuses).scalar_subquery())
+        # Each reorder leaves the keys higher; bring them back down before they outgrow the column
+        if db.session.execute(self._tail(doctor_id, statuses)).scalar() > app.config['QUEUE_ORDER_MAX']:
+            self.renumber(doctor_id, statuses)
+
+    def renumber(self, doctor_id, statuses):
+        # First shift the whole queue below zero and below its lowest key, which
+        # keeps the order and also takes the write lock, then spread it out from GAP
+        keys = aliased(WaitingRoom)
+        lowest = func.min(keys.queue_order)
+        shift = select(func.max(keys.queue_order) + 1 - case((lowest < 0, lowest), else_=0)).where(keys.doctor_id == doctor_id, keys.status.in_(statuses)).scalar_subquery()
+        self._queue(doctor_id, statuses).update({WaitingRoom.queue_order: WaitingRoom.queue_order - shift}, synchronize_session=False)
+        ids = [row.id for row in self._queue(doctor_id, statuses).with_entities(WaitingRoom.id).order_by(WaitingRoom.queue_order, WaitingRoom.id)]
+        gap = app.config['QUEUE_ORDER_GAP']
+        self._assign(doctor_id, statuses, {waiting_id: (index + 1) * gap for index, waiting_id in enumerate(ids)})
+
+    def renumber_duplicates(self):
+        # Queues from before the unique indexes may share keys; spread them out
+        for statuses in (PENDING, ACTIVE):
+            doctor_ids = {row.doctor_id for row in db.session.query(WaitingRoom.doctor_id).filter(WaitingRoom.status.in_(statuses)).group_by(WaitingRoom.doctor_id, WaitingRoom.queue_order).having(func.count() > 1)}
+            for doctor_id in doctor_ids:
+                self.renumber(doctor_id, statuses)
+                db.session.commit()  # one queue per transaction
+
+    def schedule_renumber(self, doctor_id, statuses):
+        with self._lock:
+            self._scheduled.add((doctor_id, statuses))
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='queue-renumber', daemon=True)
+                self._worker.start()
+        self._wakeup.set()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            with self._lock:
+                scheduled, self._scheduled = self._scheduled, set()
+            with app.app_context():
+                for doctor_id, statuses in scheduled:
+                    try:
+                        self.renumber(doctor_id, statuses)
+                        db.session.commit()
+                    except Exception:
+                        db.session.rollback()
+                        app.logger.exception('Queue renumbering failed for doctor %s', doctor_id)
+
+queue_ordering = QueueOrdering()
+
+class NotificationOutbox:
+    # Delivers Notification rows to the patients' inboxes in batches. Each batch
+    # deletes the rows it claims (DELETE ... RETURNING) and inserts the messages
+    # in one transaction, so a notification is delivered exactly once even with
+    # several worker processes. The worker is woken by commits that add
+    # notifications and also polls, to pick up rows left by other processes.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._worker = None
+
+    def start(self):
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name='notification-outbox', daemon=True)
+                self._worker.start()
+
+    def wake(self):
+        self.start()
+        self._wakeup.set()
+
+    def deliver_batch(self):
+        ids = [row.id for row in db.session.query(Notification.id).order_by(Notification.id).limit(app.config['OUTBOX_BATCH_SIZE'])]
+        if not ids:
+            db.session.rollback()
+            return 0
+        claimed = db.session.execute(delete(Notification).where(Notification.id.in_(ids)).returning(
+            Notification.sender_id, Notification.receiver_id, Notification.content, Notification.created_at).execution_options(synchronize_session=False)).all()
+        if claimed:
+            # Bulk insert skips the flush hook, so publish the inbox changes here
+            db.session.execute(insert(Message), [{'sender_id': row.sender_id, 'receiver_id': row.receiver_id, 'content': row.content, 'timestamp': row.created_at, 'read': False} for row in claimed])
+            touch_live(db.session, *{('user', row.receiver_id) for row in claimed})
+        db.session.commit()
+        return len(claimed)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(app.config['OUTBOX_POLL_INTERVAL'])
+            self._wakeup.clear()
+            with app.app_context():
+                try:
+                    while self.deliver_batch() >= app.config['OUTBOX_BATCH_SIZE']:
+                        pass
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception('Notification delivery failed')
+
+notification_outbox = NotificationOutbox()
+
+def notify(sender_id, receiver_id, content):
+    # Queue a notification in the current transaction; it is delivered after commit
+    notification = Notification(sender_id=sender_id, receiver_id=receiver_id, content=content)
+    db.session.add(notification)
+    return notification
+
+class Metrics:
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+    # Endpoints the pages hit on a timer
+    POLLING_ENDPOINTS = {'api_snapshot', 'api_unread_count', 'api_latest_unread_message', 'api_queue_position', 'api_active_consultations', 'api_waiting_requests', 'api_chat_messages'}
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._latency = {}  # (endpoint, method) -> [bucket counts..., +Inf count, sum]
+        self._queries = {}  # endpoint -> [statement count, seconds]
+        self._polls = {}
+        self._slow_queries = 0
+
+    def observe_request(self, endpoint, method, seconds, query_count, query_seconds):
+        with self._lock:
+            buckets = self._latency.setdefault((endpoint, method), [0] * (len(self.LATENCY_BUCKETS) + 1) + [0.0])
+            for i, bound in enumerate(self.LATENCY_BUCKETS):
+                if seconds <= bound:
+                    buckets[i] += 1
+            buckets[-2] += 1
+            buckets[-1] += seconds
+            queries = self._queries.setdefault(endpoint, [0, 0.0])
+            queries[0] += query_count
+            queries[1] += query_seconds
+            if endpoint in self.POLLING_ENDPOINTS:
+                self._polls[endpoint] = self._polls.get(endpoint, 0) + 1
+
+    def observe_slow_query(self):
+        with self._lock:
+            self._slow_queries += 1
+
+    def render(self):
+        lines = []
+        with self._lock:
+            lines.append('# HELP medicapp_request_duration_seconds Request latency by endpoint.')
+            lines.append('# TYPE medicapp_request_duration_seconds histogram')
+            for (endpoint, method), buckets in sorted(self._latency.items()):
+                labels = f'endpoint="{endpoint}",method="{method}"'
+                for bound, count in zip(self.LATENCY_BUCKETS, buckets):
+                    lines.append(f'medicapp_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'medicapp_request_duration_seconds_bucket{{{labels},le="+Inf"}} {buckets[-2]}')
+                lines.append(f'medicapp_request_duration_seconds_sum{{{labels}}} {buckets[-1]:.6f}')
+                lines.append(f'medicapp_request_duration_seconds_count{{{labels}}} {buckets[-2]}')
+            lines.append('# HELP medicapp_db_statements_total SQL statements executed, by endpoint.')
+            lines.append('# TYPE medicapp_db_statements_total counter')
+            for endpoint, (count, _) in sorted(self._queries.items()):
+                lines.append(f'medicapp_db_statements_total{{endpoint="{endpoint}"}} {count}')
+            lines.append('# HELP medicapp_db_seconds_total Time spent in SQL statements, by endpoint.')
+            lines.append('# TYPE medicapp_db_seconds_total counter')
+            for endpoint, (_, seconds) in sorted(self._queries.items()):
+                lines.append(f'medicapp_db_seconds_total{{endpoint="{endpoint}"}} {seconds:.6f}')
+            lines.append('# HELP medicapp_poll_requests_total Hits on polling endpoints.')
+            lines.append('# TYPE medicapp_poll_requests_total counter')
+            for endpoint, count in sorted(self._polls.items()):
+                lines.append(f'medicapp_poll_requests_total{{endpoint="{endpoint}"}} {count}')
+            lines.append('# HELP medicapp_slow_queries_total SQL statements slower than SLOW_QUERY_MS.')
+            lines.append('# TYPE medicapp_slow_queries_total counter')
+            lines.append(f'medicapp_slow_queries_total {self._slow_queries}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+def init_metrics():
+    with app.app_context():
+        engine = db.engine
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_started = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def _record_query(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._metrics_started
+        if elapsed * 1000 > app.config['SLOW_QUERY_MS']:
+            metrics.observe_slow_query()
+            app.logger.warning('Slow query (%.1f ms): %s', elapsed * 1000, ' '.join(statement.split()))
+        if has_request_context() and 'query_count' in g:
+            g.query_count += 1
+            g.query_seconds += elapsed
+
+    @app.before_request
+    def _start_request_timer():
+        g.request_started = time.perf_counter()
+        g.query_count = 0
+        g.query_seconds = 0.0
+
+    @app.after_request
+    def _record_request(response):
+        if 'request_started' not in g:
+            return response
+        elapsed = time.perf_counter() - g.request_started
+        endpoint = request.endpoint or 'unmatched'
+        metrics.observe_request(endpoint, request.method, elapsed, g.query_count, g.query_seconds)
+        if app.config['METRICS_HEADERS']:
+            response.headers['X-Query-Count'] = str(g.query_count)
+            response.headers['Server-Timing'] = f'db;dur={g.query_seconds * 1000:.1f};desc="{g.query_count} queries", app;dur={elapsed * 1000:.1f}'
+        return response
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+if app.config['METRICS_ENABLED']:
+    init_metrics()
+
+class AssetManifest:
+    # Maps files under static/ ('js/script.js') to the fingerprinted copies that
+    # build_assets.py writes to static/dist ('js/script.3f2a9c1b7e4d.js'). The
+    # manifest is re-read when it changes; without a build there is none and
+    # asset_url() falls back to the plain /static URL.
+    def __init__(self, path):
+        self._path = path
+        self._mtime = None
+        self._entries = {}
+
+    def get(self, filename):
+        try:
+            mtime = os.stat(self._path).st_mtime
+        except OSError:
+            return None
+        if mtime != self._mtime:
+            with open(self._path, encoding='utf-8') as f:
+                self._entries = json.load(f)
+            self._mtime = mtime
+        return self._entries.get(filename)
+
+ASSET_DIR = os.path.join(app.static_folder, 'dist')
+asset_manifest = AssetManifest(os.path.join(ASSET_DIR, 'manifest.json'))
+
+@app.template_global()
+def asset_url(filename):
+    fingerprinted = asset_manifest.get(filename)
+    if fingerprinted:
+        return url_for('assets', filename=fingerprinted)
+    return url_for('static', filename=filename)
+
+@app.route('/assets/<path:filename>')
+def assets(filename):
+    # A fingerprinted name never changes content, so browsers may keep it for
+    # good; the .br/.gz copies made at build time are sent as they are
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        path = safe_join(ASSET_DIR, filename + suffix)
+        if encoding in request.accept_encodings and path and os.path.isfile(path):
+            response = send_from_directory(ASSET_DIR, filename + suffix, mimetype=mimetypes.guess_type(filename)[0])
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(ASSET_DIR, filename)
+    response.headers['Cache-Control'] = f"public, max-age={app.config['ASSET_MAX_AGE']}, immutable"
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.after_request
+def compress_json(response):
+    # JSON of at least JSON_COMPRESS_MIN_BYTES is gzipped for clients that accept
+    # it. Its ETag becomes weak, since the bytes differ from the plain response.
+    if response.mimetype != 'application/json' or response.direct_passthrough or response.is_streamed or 'Content-Encoding' in response.headers:
+        return response
+    response.vary.add('Accept-Encoding')
+    if 'gzip' not in request.accept_encodings or (response.content_length or 0) < app.config['JSON_COMPRESS_MIN_BYTES']:
+        return response
+    response.set_data(gzip.compress(response.get_data(), app.config['JSON_COMPRESS_LEVEL']))
+    response.headers['Content-Encoding'] = 'gzip'
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+class UserCache:
+    # Bounded LRU of user column values with a TTL. Writers call invalidate()
+    # after committing; the TTL bounds staleness across worker processes.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = OrderedDict()  # user_id -> (expires_at, column values)
+
+    def get(self, user_id):
+        with self._lock:
+            item = self._items.get(user_id)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self._items[user_id]
+                return None
+            self._items.move_to_end(user_id)
+            return item[1]
+
+    def put(self, user_id, values):
+        with self._lock:
+            self._items[user_id] = (time.monotonic() + app.config['USER_CACHE_TTL'], values)
+            self._items.move_to_end(user_id)
+            while len(self._items) > app.config['USER_CACHE_SIZE']:
+                self._items.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._items.pop(user_id, None)
+
+user_cache = UserCache()
+
+class HashingBusy(Exception):
+    pass
+
+class LoginThrottled(Exception):
+    def __init__(self, retry_after):
+        super().__init__(retry_after)
+        self.retry_after = retry_after
+
+class PasswordHasher:
+    # Password hashing on a small thread pool (hashlib releases the GIL), so a
+    # login storm can't put every request thread on CPU-bound work: at most
+    # PASSWORD_HASH_WORKERS hashes run and PASSWORD_HASH_QUEUE wait, and any
+    # further request fails fast with HashingBusy. With no workers configured
+    # hashing runs inline on the request thread, as it used to.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._executor = None
+        self._slots = None
+        self._prefixes = {}  # method -> the method with every parameter, as stored
+
+    def _prefix(self, method):
+        # Hashes store the method with the parameters werkzeug filled in
+        # ('pbkdf2:sha256' is stored as 'pbkdf2:sha256:600000'), so expand
+        # the configured one the same way before comparing
+        if method not in self._prefixes:
+            self._prefixes[method] = generate_password_hash('', method).split('$', 1)[0]
+        return self._prefixes[method]
+
+    def _run(self, fn, *args):
+        workers = app.config['PASSWORD_HASH_WORKERS']
+        if not workers:
+            return fn(*args)
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+                self._slots = threading.BoundedSemaphore(workers + app.config['PASSWORD_HASH_QUEUE'])
+        if not self._slots.acquire(blocking=False):
+            raise HashingBusy()
+        try:
+            future = self._executor.submit(fn, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+    def verify(self, stored, password):
+        # Returns (matches, new hash or None); a hash made with another method
+        # or cost than PASSWORD_HASH_METHOD is redone while the password is at hand
+        method = app.config['PASSWORD_HASH_METHOD']
+        def check():
+            if not check_password_hash(stored, password):
+                return False, None
+            if stored.split('$', 1)[0] != self._prefix(method):
+                return True, generate_password_hash(password, method)
+            return True, None
+        return self._run(check)
+
+password_hasher = PasswordHasher()
+
+class LoginThrottle:
+    # Failed logins per username; after LOGIN_MAX_FAILURES within
+    # LOGIN_FAILURE_WINDOW seconds the username is refused without hashing
+    # until the window ends. Per process, bounded like the user cache.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._failures = OrderedDict()  # username -> (window_ends_at, failures)
+
+    def retry_after(self, username):
+        with self._lock:
+            item = self._failures.get(username)
+            if item is None:
+                return 0
+            remaining = item[0] - time.monotonic()
+            if remaining <= 0:
+                del self._failures[username]
+                return 0
+            return int(remaining) + 1 if item[1] >= app.config['LOGIN_MAX_FAILURES'] else 0
+
+    def failed(self, username):
+        now = time.monotonic()
+        with self._lock:
+            window_ends_at, failures = self._failures.get(username, (0, 0))
+            if window_ends_at <= now:
+                window_ends_at, failures = now + app.config['LOGIN_FAILURE_WINDOW'], 0
+            self._failures[username] = (window_ends_at, failures + 1)
+            self._failures.move_to_end(username)
+            while len(self._failures) > app.config['LOGIN_THROTTLE_SIZE']:
+                self._failures.popitem(last=False)
+
+    def succeeded(self, username):
+        with self._lock:
+            self._failures.pop(username, None)
+
+login_throttle = LoginThrottle()
+
+def authenticate(username, password):
+    # The user, or None for bad credentials. Raises LoginThrottled before any
+    # hashing once a username has failed too often, and HashingBusy when the
+    # hashing pool is full.
+    wait = login_throttle.retry_after(username)
+    if wait:
+        raise LoginThrottled(wait)
+    user = User.query.filter_by(username=username).first()
+    matches, upgraded = password_hasher.verify(user.password, password) if user else (False, None)
+    if not matches:
+        login_throttle.failed(username)
+        return None
+    login_throttle.succeeded(username)
+    if upgraded:
+        user.password = upgraded
+        db.session.commit()
+        user_cache.invalidate(user.id)
+    return user
+USER_COLUMNS = [column.key for column in User.__table__.columns]
+
+class DoctorDirectory:
+    # On-shift doctors as plain dicts, one listing per specialty filter, with a
+    # content digest used as ETag. Writers call invalidate() after committing a
+    # change to a doctor's shift, profile or ratings. With REDIS_URL set the
+    # listings and a generation counter are shared, so an invalidation in one
+    # worker reaches all of them; otherwise the TTL bounds staleness.
+    GENERATION_KEY = 'medicapp:doctors:generation'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = OrderedDict()  # specialty -> (expires_at, generation, (doctors, version))
+        self._redis = None
+        self._redis_url = None
+
+    def _shared(self):
+        url = app.config['REDIS_URL']
+        if not url or redis is None:
+            return None
+        if self._redis_url != url:
+            self._redis, self._redis_url = redis.Redis.from_url(url), url
+        return self._redis
+
+    def _generation(self, shared):
+        if shared is None:
+            return None
+        try:
+            return int(shared.get(self.GENERATION_KEY) or 0)
+        except redis.RedisError:
+            return None
+
+    def get(self, specialty=None):
+        # Returns (doctors, version)
+        shared = self._shared()
+        generation = self._generation(shared)
+        with self._lock:
+            item = self._items.get(specialty)
+            if item and item[0] >= time.monotonic() and item[1] == generation:
+                self._items.move_to_end(specialty)
+                return item[2]
+        listing = None
+        if generation is not None:
+            try:
+                stored = shared.get(f'medicapp:doctors:{generation}:{specialty or ""}')
+                if stored:
+                    listing = tuple(json.loads(stored))
+            except redis.RedisError:
+                pass
+        if listing is None:
+            listing = self._load(specialty)
+            if generation is not None:
+                try:
+                    shared.set(f'medicapp:doctors:{generation}:{specialty or ""}', json.dumps(listing), ex=app.config['DOCTOR_DIRECTORY_TTL'])
+                except redis.RedisError:
+                    pass
+        with self._lock:
+            self._items[specialty] = (time.monotonic() + app.config['DOCTOR_DIRECTORY_TTL'], generation, listing)
+            self._items.move_to_end(specialty)
+            while len(self._items) > app.config['DOCTOR_DIRECTORY_SIZE']:
+                self._items.popitem(last=False)
+        return listing
+
+    def _load(self, specialty):
+        query = db.session.query(User.id, User.username, User.name, User.specialty, User.description, User.rating_sum, User.rating_count).filter(User.role == 'doctor', User.on_shift == True)
+        if specialty:
+            query = query.filter(User.specialty == specialty)
+        doctors = [{
+            'id': row.id,
+            'username': row.username,
+            'name': row.name,
+            'specialty': row.specialty,
+            'description': row.description,
+            'avg_rating': round(row.rating_sum / row.rating_count, 1) if row.rating_count else 0,
+        } for row in query.order_by(User.id)]
+        version = hashlib.sha1(json.dumps(doctors, sort_keys=True).encode()).hexdigest()[:16]
+        return doctors, version
+
+    def invalidate(self):
+        with self._lock:
+            self._items.clear()
+        shared = self._shared()
+        if shared is not None:
+            try:
+                shared.incr(self.GENERATION_KEY)
+            except redis.RedisError:
+                app.logger.warning('Could not invalidate the shared doctor directory')
+
+doctor_directory = DoctorDirectory()
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user_id = int(user_id)
+    values = user_cache.get(user_id)
+    if values is None:
+        user = db.session.get(User, user_id)
+        if user:
+            user_cache.put(user_id, {key: getattr(user, key) for key in USER_COLUMNS})
+        return user
+    # Rebuild the row without a SELECT and attach it to the session as persistent,
+    # so current_user can still lazy-load relationships and be modified and committed
+    user = User(**values)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+def fresh_current_user():
+    # current_user may be rebuilt from the cache and up to USER_CACHE_TTL old;
+    # writes start from the row itself, which also refreshes current_user
+    return db.session.get(User, current_user.id, populate_existing=True)
 
 @app.route('/')
 def index():
@@ -98,10 +1247,18 @@ def register():
         if User.query.filter_by(username=username).first():
             flash('Username already exists')
             return redirect(url_for('register'))
-        hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
+        try:
+            hashed_password = password_hasher.hash(password)
+        except HashingBusy:
+            flash('El servidor está ocupado, intentá de nuevo en unos segundos.')
+            return render_template('register.html'), 503, {'Retry-After': '1'}
         new_user = User(username=username, password=hashed_password, role=role, name=name, description=description, specialty=specialty)
         db.session.add(new_user)
         db.session.commit()
+        # SQLite can reuse the id of a deleted user, so drop anything cached under it
+        user_cache.invalidate(new_user.id)
+        if role == 'doctor':
+            doctor_directory.invalidate()
         flash('Registration successful, please login')
         return redirect(url_for('login'))
     return render_template('register.html')
@@ -111,8 +1268,15 @@ def login():
     if request.method == 'POST':
         username = request.form.get('username')
         password = request.form.get('password')
-        user = User.query.filter_by(username=username).first()
-        if user and check_password_hash(user.password, password):
+        try:
+            user = authenticate(username, password)
+        except LoginThrottled as e:
+            flash(f'Demasiados intentos fallidos. Intentá de nuevo en {e.retry_after} segundos.')
+            return render_template('login.html'), 429, {'Retry-After': str(e.retry_after)}
+        except HashingBusy:
+            flash('El servidor está ocupado, intentá de nuevo en unos segundos.')
+            return render_template('login.html'), 503, {'Retry-After': '1'}
+        if user:
             login_user(user)
             return redirect(url_for('dashboard'))
         flash('Invalid username or password')
@@ -131,25 +1295,63 @@ def dashboard():
         return render_template('doctor_dashboard.html')
     return render_template('dashboard.html')
 
+# Keyset pagination: pages are read in index order starting after a cursor
+# taken from the last row of the previous page, so a page costs the same no
+# matter how deep into the list it is. Date-ordered cursors are "<iso date>_<id>".
+def make_cursor(value, item_id):
+    return f"{value.isoformat()}_{item_id}"
+
+def parse_cursor(cursor):
+    try:
+        value, _, item_id = cursor.rpartition('_')
+        return datetime.fromisoformat(value), int(item_id)
+    except (AttributeError, ValueError):
+        return None
+
+def fetch_page(query):
+    page_size = app.config['LIST_PAGE_SIZE']
+    items = query.limit(page_size + 1).all()
+    return items[:page_size], len(items) > page_size
+
+def patients_page(after_id):
+    query = Patient.query.order_by(Patient.id)
+    if after_id:
+        query = query.filter(Patient.id > after_id)
+    patients, has_more = fetch_page(query)
+    return patients, patients[-1].id if has_more else None
+
+def appointments_page(cursor):
+    query = Appointment.query.options(selectinload(Appointment.patient), selectinload(Appointment.doctor)).order_by(Appointment.date, Appointment.id)
+    after = parse_cursor(cursor)
+    if after:
+        query = query.filter(tuple_(Appointment.date, Appointment.id) > tuple_(*after))
+    appointments, has_more = fetch_page(query)
+    return appointments, make_cursor(appointments[-1].date, appointments[-1].id) if has_more else None
+
 @app.route('/patients')
 @login_required
 def patients():
-    patients = Patient.query.all()
-    return render_template('patients.html', patients=patients)
+    patients, next_cursor = patients_page(request.args.get('after', type=int))
+    return render_template('patients.html', patients=patients, next_cursor=next_cursor)
 
 @app.route('/appointments')
 @login_required
 def appointments():
-    appointments = Appointment.query.all()
-    return render_template('appointments.html', appointments=appointments)
+    appointments, next_cursor = appointments_page(request.args.get('after'))
+    return render_template('appointments.html', appointments=appointments, next_cursor=next_cursor)
 
 @app.route('/api/login', methods=['POST'])
 def api_login():
     data = request.get_json()
     username = data.get('username')
     password = data.get('password')
-    user = User.query.filter_by(username=username).first()
-    if user and check_password_hash(user.password, password):
+    try:
+        user = authenticate(username, password)
+    except LoginThrottled as e:
+        return jsonify({'message': 'Too many failed attempts'}), 429, {'Retry-After': str(e.retry_after)}
+    except HashingBusy:
+        return jsonify({'message': 'Server busy'}), 503, {'Retry-After': '1'}
+    if user:
         login_user(user)
         return jsonify({'message': 'Login successful'})
     return jsonify({'message': 'Invalid credentials'}), 401
@@ -157,54 +1359,82 @@ def api_login():
 @app.route('/api/patients', methods=['GET'])
 @login_required
 def api_patients():
-    patients = Patient.query.all()
+    patients, next_cursor = patients_page(request.args.get('after', type=int))
+    return jsonify({
+        'patients': [{'id': p.id, 'name': p.name, 'age': p.age, 'gender': p.gender} for p in patients],
+        'next_cursor': next_cursor
+    })
+
 @app.route('/toggle_shift', methods=['POST'])
 @login_required
 def toggle_shift():
     if current_user.role != 'doctor':
         return jsonify({'error': 'Not a doctor'}), 403
-    current_user.on_shift = not current_user.on_shift
+    user_id = current_user.id
+    # Flip the stored value, not the possibly cached one
+    on_shift = db.session.execute(update(User).where(User.id == user_id).values(on_shift=~User.on_shift).returning(User.on_shift)).scalar_one()
     db.session.commit()
-    return jsonify({'on_shift': current_user.on_shift})
+    user_cache.invalidate(user_id)
+    doctor_directory.invalidate()
+    return jsonify({'on_shift': on_shift})
 
 @app.route('/guardias')
 @login_required
 def guardias():
     if current_user.role != 'patient':
         return redirect(url_for('dashboard'))
-    doctors = []
-    for doctor in User.query.filter_by(role='doctor', on_shift=True):
-        avg_rating = db.session.query(func.avg(Feedback.rating)).filter(Feedback.to_user_id == doctor.id).scalar() or 0
-        doctor.avg_rating = round(avg_rating, 1) if avg_rating else 0
-        doctors.append(doctor)
+    doctors, _ = doctor_directory.get()
     # Check if patient is in any waiting room
-    current_waiting = WaitingRoom.query.filter_by(patient_id=current_user.id, status='pending').first()
+    current_waiting = None
     position = None
-    if current_waiting:
-        # Count how many pending requests have lower queue_order for the same doctor
-        position = WaitingRoom.query.filter(
-            WaitingRoom.doctor_id == current_waiting.doctor_id,
-            WaitingRoom.status == 'pending',
-            WaitingRoom.queue_order <= current_waiting.queue_order
-        ).count()
-    return render_template('guardias.html', doctors=doctors, current_waiting=current_waiting, position=position)
+    queued = queue_index.position(current_user.id)
+    if queued:
+        current_waiting = WaitingRoom.query.get(queued[0])
+        position = queued[2]
+    specialties = sorted({doctor['specialty'] for doctor in doctors if doctor['specialty']})
+    return render_template('guardias.html', doctors=doctors, current_waiting=current_waiting, position=position,
+                           specialties=specialties, dispatch=app.config['GUARDIA_DISPATCH'])
+
+@app.route('/api/doctors')
+@login_required
+def api_doctors():
+    doctors, version = doctor_directory.get(request.args.get('specialty') or None)
+    if request.if_none_match.contains_weak(version):
+        response = Response(status=304)
+    else:
+        response = jsonify({'doctors': doctors})
+    response.set_etag(version)
+    return response
 
 @app.route('/enter_waiting_room/<int:doctor_id>', methods=['POST'])
 @login_required
 def enter_waiting_room(doctor_id):
     if current_user.role != 'patient':
         return jsonify({'error': 'Not a patient'}), 403
+    if app.config['GUARDIA_DISPATCH'] == 'auto':
+        return jsonify({'error': 'El médico se asigna automáticamente'}), 403
     symptoms = request.form.get('symptoms')
     if not symptoms:
         return jsonify({'error': 'Symptoms required'}), 400
-    # Get the next queue order
-    max_order = db.session.query(func.max(WaitingRoom.queue_order)).filter_by(doctor_id=doctor_id, status='pending').scalar() or 0
-    waiting = WaitingRoom(patient_id=current_user.id, doctor_id=doctor_id, symptoms=symptoms, queue_order=max_order + 1)
-    db.session.add(waiting)
-    db.session.commit()
+    queue_ordering.admit(current_user.id, doctor_id, symptoms)
     doctor = User.query.get(doctor_id)
     return jsonify({'message': f'Se ha solicitado entrar a la sala de espera del doctor {doctor.username}'})
 
+@app.route('/enter_waiting_room/auto', methods=['POST'])
+@login_required
+def dispatch_waiting_room():
+    if current_user.role != 'patient':
+        return jsonify({'error': 'Not a patient'}), 403
+    symptoms = request.form.get('symptoms')
+    if not symptoms:
+        return jsonify({'error': 'Symptoms required'}), 400
+    doctor_id = doctor_load.pick(request.form.get('specialty'))
+    if doctor_id is None:
+        return jsonify({'error': 'No hay médicos de guardia en este momento'}), 503
+    queue_ordering.admit(current_user.id, doctor_id, symptoms)
+    doctor = User.query.get(doctor_id)
+    return jsonify({'message': f'Se ha solicitado entrar a la sala de espera del doctor {doctor.name or doctor.username}', 'doctor_id': doctor_id})
+
 @app.route('/waiting_requests')
 @login_required
 def waiting_requests():
@@ -212,10 +1442,17 @@ def waiting_requests():
         return redirect(url_for('dashboard'))
     now = datetime.utcnow()
     yesterday = now - timedelta(hours=24)
-    active_requests = WaitingRoom.query.filter(WaitingRoom.doctor_id == current_user.id, WaitingRoom.status.in_(['pending', 'accepted', 'in_room'])).order_by(WaitingRoom.queue_order).all()
-    today_consultations = WaitingRoom.query.filter(WaitingRoom.doctor_id == current_user.id, WaitingRoom.status == 'completed', WaitingRoom.end_time >= yesterday).order_by(WaitingRoom.end_time.desc()).all()
-    history_consultations = WaitingRoom.query.filter(WaitingRoom.doctor_id == current_user.id, WaitingRoom.status == 'completed', WaitingRoom.end_time < yesterday).order_by(WaitingRoom.end_time.desc()).all()
-    return render_template('waiting_requests.html', active_requests=active_requests, today_consultations=today_consultations, history_consultations=history_consultations)
+    with_patient = WaitingRoom.query.options(selectinload(WaitingRoom.patient))
+    active_requests = with_patient.filter(WaitingRoom.doctor_id == current_user.id, WaitingRoom.status.in_(['pending', 'accepted', 'in_room'])).order_by(WaitingRoom.queue_order).all()
+    today_consultations = with_patient.filter(WaitingRoom.doctor_id == current_user.id, WaitingRoom.status == 'completed', WaitingRoom.end_time >= yesterday).order_by(WaitingRoom.end_time.desc()).all()
+    # Older history is paged with ?history_before=<cursor>
+    history_query = with_patient.filter(WaitingRoom.doctor_id == current_user.id, WaitingRoom.status == 'completed', WaitingRoom.end_time < yesterday).order_by(WaitingRoom.end_time.desc(), WaitingRoom.id.desc())
+    before = parse_cursor(request.args.get('history_before'))
+    if before:
+        history_query = history_query.filter(tuple_(WaitingRoom.end_time, WaitingRoom.id) < tuple_(*before))
+    history_consultations, has_more = fetch_page(history_query)
+    history_next = make_cursor(history_consultations[-1].end_time, history_consultations[-1].id) if has_more else None
+    return render_template('waiting_requests.html', active_requests=active_requests, today_consultations=today_consultations, history_consultations=history_consultations, history_next=history_next)
 
 @app.route('/accept_waiting/<int:id>', methods=['POST'])
 @login_required
@@ -225,15 +1462,11 @@ def accept_waiting(id):
     waiting = WaitingRoom.query.get(id)
     if waiting and waiting.doctor_id == current_user.id:
         try:
-            # Assign queue order for accepted requests
-            max_order = db.session.query(func.max(WaitingRoom.queue_order)).filter(WaitingRoom.doctor_id == current_user.id, WaitingRoom.status.in_(['accepted', 'in_room'])).scalar() or 0
-            waiting.queue_order = max_order + 1
-            waiting.status = 'accepted'
-            db.session.commit()
-            # Send notification message to patient
-            message = Message(sender_id=current_user.id, receiver_id=waiting.patient_id, content=f"Tu solicitud ha sido aceptada por el doctor {current_user.name or current_user.username}.")
-            db.session.add(message)
-            db.session.commit()
+            patient_id = waiting.patient_id
+            # The request moves to the tail of the accepted queue and the patient's
+            # notification is queued, in one transaction
+            notification = notify(current_user.id, patient_id, f"Tu solicitud ha sido aceptada por el doctor {current_user.name or current_user.username}.")
+            queue_ordering.accept(id, current_user.id, patient_id, extra=[notification])
         except Exception as e:
             db.session.rollback()
             flash('Error al aceptar la solicitud.', 'error')
@@ -247,10 +1480,7 @@ def reject_waiting(id):
     waiting = WaitingRoom.query.get(id)
     if waiting and waiting.doctor_id == current_user.id:
         waiting.status = 'rejected'
-        db.session.commit()
-        # Send notification message to patient
-        message = Message(sender_id=current_user.id, receiver_id=waiting.patient_id, content=f"Tu solicitud ha sido rechazada por el doctor {current_user.name or current_user.username}.")
-        db.session.add(message)
+        notify(current_user.id, waiting.patient_id, f"Tu solicitud ha sido rechazada por el doctor {current_user.name or current_user.username}.")
         db.session.commit()
     return redirect(url_for('waiting_requests'))
 
@@ -279,6 +1509,20 @@ def messages():
         return render_template('messages.html', waitings=waitings)
     return render_template('messages.html', waitings=[])
 
+def conversation_query(user_id, other_id):
+    return Message.query.filter(
+        ((Message.sender_id == user_id) & (Message.receiver_id == other_id)) |
+        ((Message.sender_id == other_id) & (Message.receiver_id == user_id))
+    )
+
+def mark_conversation_read(user_id, other_id):
+    # One set-based UPDATE, and only when there is something to mark
+    unread = Message.query.filter_by(sender_id=other_id, receiver_id=user_id, read=False)
+    if db.session.query(unread.exists()).scalar():
+        unread.update({'read': True}, synchronize_session=False)
+        touch_live(db.session, ('user', user_id))
+        db.session.commit()
+
 @app.route('/chat/<int:user_id>')
 @login_required
 def chat(user_id):
@@ -294,14 +1538,17 @@ def chat(user_id):
         waiting = WaitingRoom.query.filter_by(doctor_id=current_user.id, patient_id=user_id, chat_enabled=True).first()
         if not waiting:
             return redirect(url_for('messages'))
-    messages = Message.query.filter(
-        ((Message.sender_id == current_user.id) & (Message.receiver_id == user_id)) |
-        ((Message.sender_id == user_id) & (Message.receiver_id == current_user.id))
-    ).order_by(Message.timestamp).all()
-    room_name = f"medicapp-{min(current_user.id, user_id)}-{max(current_user.id, user_id)}"
-    recent_call = any(m.content.startswith("Videollamada") and (datetime.utcnow() - m.timestamp) < timedelta(hours=1) for m in messages)
+    mark_conversation_read(current_user.id, user_id)
+    # Only the most recent page is rendered; older history is loaded on demand
+    page_size = app.config['CHAT_PAGE_SIZE']
+    messages = conversation_query(current_user.id, user_id).order_by(Message.id.desc()).limit(page_size + 1).all()
+    has_more = len(messages) > page_size
+    messages = list(reversed(messages[:page_size]))
+    room_name = call_room_name(current_user.id, user_id)
+    doctor_id, patient_id = (current_user.id, user_id) if current_user.role == 'doctor' else (user_id, current_user.id)
+    recent_call = CallSession.query.filter(CallSession.doctor_id == doctor_id, CallSession.patient_id == patient_id, CallSession.started_at > datetime.utcnow() - timedelta(hours=1)).first() is not None
     waiting_id = waiting.id if waiting else None
-    return render_template('chat.html', other_user=other_user, messages=messages, room_name=room_name, show_feedback=recent_call, waiting_id=waiting_id)
+    return render_template('chat.html', other_user=other_user, messages=messages, has_more=has_more, page_size=page_size, room_name=room_name, show_feedback=recent_call, waiting_id=waiting_id)
 
 @app.route('/send_message/<int:user_id>', methods=['POST'])
 @login_required
@@ -318,11 +1565,22 @@ def send_message(user_id):
 def start_video_call(user_id):
     if current_user.role != 'doctor':
         return redirect(url_for('dashboard'))
-    # Update waiting room status to in_room
-    waiting = WaitingRoom.query.filter_by(doctor_id=current_user.id, patient_id=user_id, status='accepted').first()
+    # Update waiting room status to in_room (a restarted call finds it there already)
+    waiting = WaitingRoom.query.filter(WaitingRoom.doctor_id == current_user.id, WaitingRoom.patient_id == user_id, WaitingRoom.status.in_(('accepted', 'in_room'))).first()
     if waiting:
         waiting.status = 'in_room'
-    room_name = f"medicapp-{min(current_user.id, user_id)}-{max(current_user.id, user_id)}"
+    room_name = call_room_name(current_user.id, user_id)
+    # A call still open for this consultation is rejoined; any other call
+    # still open between the two is over
+    now = datetime.utcnow()
+    call = None
+    for open_call in CallSession.query.filter_by(doctor_id=current_user.id, patient_id=user_id, ended_at=None):
+        if call is None and waiting and open_call.waiting_id == waiting.id:
+            call = open_call
+        else:
+            open_call.finish(now)
+    if call is None:
+        db.session.add(CallSession(waiting_id=waiting.id if waiting else None, doctor_id=current_user.id, patient_id=user_id, room_name=room_name, started_at=now))
     message_content = f"Videollamada iniciada. Unirse: https://meet.jit.si/{room_name}"
     message = Message(sender_id=current_user.id, receiver_id=user_id, content=message_content)
     db.session.add(message)
@@ -337,6 +1595,8 @@ def complete_call(waiting_id):
     if waiting and waiting.patient_id == current_user.id and waiting.status == 'in_room':
         waiting.status = 'completed'
         waiting.end_time = datetime.utcnow()
+        for call in CallSession.query.filter_by(waiting_id=waiting_id, ended_at=None):
+            call.finish(waiting.end_time)
         db.session.commit()
         return redirect(url_for('feedback_form', waiting_id=waiting_id))
     return '', 204
@@ -366,24 +1626,333 @@ def submit_feedback(waiting_id):
         feedback = Feedback(from_user_id=current_user.id, to_user_id=waiting.doctor_id, rating=rating, comment=comment)
         db.session.add(feedback)
         waiting.feedback_submitted = True
+        doctor_id = waiting.doctor_id
+        User.query.filter_by(id=doctor_id).update({
+            User.rating_sum: User.rating_sum + rating,
+            User.rating_count: User.rating_count + 1
+        }, synchronize_session=False)
         db.session.commit()
+        user_cache.invalidate(doctor_id)
+        doctor_directory.invalidate()
         flash('Feedback enviado correctamente')
     else:
         flash('Rating inválido')
     return redirect(url_for('dashboard'))
 
+def rebuild_rating_totals(batch_size=1000, pause=0):
+    # Recompute every doctor's rating totals from the feedback table, batch_size
+    # doctors per transaction
+    feedback = db.session.query(Feedback).filter(Feedback.to_user_id == User.id)
+    updated = last_id = 0
+    while True:
+        ids = [row.id for row in db.session.query(User.id).filter(User.role == 'doctor', User.id > last_id).order_by(User.id).limit(batch_size)]
+        if not ids:
+            break
+        updated += User.query.filter(User.id.in_(ids)).update({
+            User.rating_sum: feedback.with_entities(func.coalesce(func.sum(Feedback.rating), 0)).scalar_subquery(),
+            User.rating_count: feedback.with_entities(func.count(Feedback.id)).scalar_subquery()
+        }, synchronize_session=False)
+        db.session.commit()
+        last_id = ids[-1]
+        time.sleep(pause)
+    return updated
+
+def backfill_call_sessions(batch_size=1000, pause=0):
+    # Recreate call records from the "Videollamada iniciada" chat messages sent
+    # before calls had their own table. Each call is linked to the pair's latest
+    # request created before it and ends when the next call starts or the
+    # consultation ends. Messages already backfilled are skipped.
+    backfilled = db.session.query(CallSession.id).filter(CallSession.doctor_id == Message.sender_id, CallSession.patient_id == Message.receiver_id, CallSession.started_at == Message.timestamp)
+    calls = db.session.query(Message.id, Message.sender_id, Message.receiver_id, Message.timestamp).filter(Message.content.startswith('Videollamada'), ~backfilled.exists())
+    previous = {}  # waiting_id -> last call created for it
+    created = last_id = 0
+    while True:
+        batch = calls.filter(Message.id > last_id).order_by(Message.id).limit(batch_size).all()
+        if not batch:
+            break
+        for message_id, doctor_id, patient_id, started_at in batch:
+            waiting = WaitingRoom.query.filter(WaitingRoom.doctor_id == doctor_id, WaitingRoom.patient_id == patient_id, WaitingRoom.created_at <= started_at).order_by(WaitingRoom.created_at.desc()).first()
+            call = CallSession(waiting_id=waiting.id if waiting else None, doctor_id=doctor_id, patient_id=patient_id, room_name=call_room_name(doctor_id, patient_id), started_at=started_at)
+            if waiting and waiting.end_time and waiting.end_time >= started_at:
+                call.finish(waiting.end_time)
+            if waiting and waiting.id in previous:
+                previous[waiting.id].finish(started_at)
+            if waiting:
+                previous[waiting.id] = call
+            db.session.add(call)
+            created += 1
+        last_id = batch[-1][0]
+        db.session.commit()
+        time.sleep(pause)
+    return created
+
+@app.route('/api/call_stats')
+@login_required
+def api_call_stats():
+    if current_user.role != 'doctor':
+        return jsonify({'error': 'Not a doctor'}), 403
+    days = request.args.get('days', 30, type=int)
+    calls, completed, avg_duration, patients = db.session.query(
+        func.count(CallSession.id), func.count(CallSession.ended_at), func.avg(CallSession.duration_seconds), func.count(func.distinct(CallSession.patient_id))
+    ).filter(CallSession.doctor_id == current_user.id, CallSession.started_at >= datetime.utcnow() - timedelta(days=days)).one()
+    return jsonify({
+        'days': days,
+        'calls': calls,
+        'completed': completed,
+        'avg_duration_seconds': round(avg_duration) if avg_duration is not None else None,
+        'patients': patients
+    })
+
+@app.route('/history')
+@login_required
+def history():
+    # Completed consultations, live and archived, newest first; paged with ?before=<cursor>
+    before = parse_cursor(request.args.get('before'))
+    page_size = app.config['LIST_PAGE_SIZE']
+    consultations = []
+    for model in (WaitingRoom, ArchivedConsultation):
+        owner = model.doctor_id if current_user.role == 'doctor' else model.patient_id
+        query = model.query.options(selectinload(model.patient), selectinload(model.doctor)).filter(owner == current_user.id, model.status == 'completed', model.end_time.isnot(None))
+        if before:
+            query = query.filter(tuple_(model.end_time, model.id) < tuple_(*before))
+        consultations += query.order_by(model.end_time.desc(), model.id.desc()).limit(page_size + 1).all()
+    consultations.sort(key=lambda c: (c.end_time, c.id), reverse=True)
+    has_more = len(consultations) > page_size
+    consultations = consultations[:page_size]
+    next_cursor = make_cursor(consultations[-1].end_time, consultations[-1].id) if has_more else None
+    return render_template('history.html', consultations=consultations, next_cursor=next_cursor)
+
+@app.route('/history/chat/<int:user_id>')
+@login_required
+def history_chat(user_id):
+    # Archived messages with another user, newest page first; paged with ?before=<id>
+    other_user = User.query.get_or_404(user_id)
+    query = ArchivedMessage.query.filter(
+        ((ArchivedMessage.sender_id == current_user.id) & (ArchivedMessage.receiver_id == user_id)) |
+        ((ArchivedMessage.sender_id == user_id) & (ArchivedMessage.receiver_id == current_user.id))
+    )
+    before_id = request.args.get('before', type=int)
+    if before_id:
+        query = query.filter(ArchivedMessage.id < before_id)
+    messages, has_more = fetch_page(query.order_by(ArchivedMessage.id.desc()))
+    next_before = messages[-1].id if has_more else None
+    return render_template('history_chat.html', other_user=other_user, messages=list(reversed(messages)), next_before=next_before)
+
+EXPORT_COLUMNS = {
+    'consultations': ['id', 'patient_id', 'patient', 'symptoms', 'status', 'created_at', 'end_time', 'feedback_submitted', 'archived'],
+    'feedback': ['id', 'patient_id', 'patient', 'rating', 'comment', 'timestamp'],
+    'messages': ['id', 'sender_id', 'receiver_id', 'sender', 'content', 'timestamp', 'archived'],
+}
+
+def export_queries(kind, doctor_id, start=None, end=None):
+    # Column-only queries (no ORM objects) over the live and archive tables
+    def dated(query, column):
+        if start:
+            query = query.filter(column >= start)
+        if end:
+            query = query.filter(column < end)
+        return query
+    name = func.coalesce(User.name, User.username)
+    if kind == 'consultations':
+        for model, archived in ((WaitingRoom, False), (ArchivedConsultation, True)):
+            query = db.session.query(model.id, model.patient_id, name, model.symptoms, model.status, model.created_at, model.end_time, model.feedback_submitted, literal(archived)).join(User, User.id == model.patient_id).filter(model.doctor_id == doctor_id)
+            yield dated(query, model.created_at).order_by(model.id)
+    elif kind == 'feedback':
+        query = db.session.query(Feedback.id, Feedback.from_user_id, name, Feedback.rating, Feedback.comment, Feedback.timestamp).join(User, User.id == Feedback.from_user_id).filter(Feedback.to_user_id == doctor_id)
+        yield dated(query, Feedback.timestamp).order_by(Feedback.id)
+    elif kind == 'messages':
+        for model, archived in ((Message, False), (ArchivedMessage, True)):
+            query = db.session.query(model.id, model.sender_id, model.receiver_id, name, model.content, model.timestamp, literal(archived)).join(User, User.id == model.sender_id).filter((model.sender_id == doctor_id) | (model.receiver_id == doctor_id))
+            yield dated(query, model.timestamp).order_by(model.id)
+
+def export_rows(kind, doctor_id, start=None, end=None):
+    # Rows are fetched EXPORT_CHUNK_SIZE at a time, so memory stays flat however large the export
+    for query in export_queries(kind, doctor_id, start, end):
+        for row in query.yield_per(app.config['EXPORT_CHUNK_SIZE']):
+            yield [value.isoformat() if isinstance(value, datetime) else value for value in row]
+
+def export_stream(kind, fmt, rows):
+    # Yields the export as text, one chunk per EXPORT_CHUNK_SIZE rows
+    columns = EXPORT_COLUMNS[kind]
+    chunk_size = app.config['EXPORT_CHUNK_SIZE']
+    buffer = io.StringIO()
+    writer = csv.writer(buffer) if fmt == 'csv' else None
+    if writer:
+        writer.writerow(columns)
+    for count, row in enumerate(rows, 1):
+        if writer:
+            writer.writerow(row)
+        else:
+            buffer.write(json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n')
+        if count % chunk_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def parse_export_date(value, end=False):
+    # YYYY-MM-DD or a full ISO timestamp; a bare end date includes that whole day
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    return parsed + timedelta(days=1) if end and len(value) == 10 else parsed
+
+@app.route('/export/<kind>.<fmt>')
+@login_required
+def export(kind, fmt):
+    if current_user.role != 'doctor':
+        return jsonify({'error': 'Not a doctor'}), 403
+    if kind not in EXPORT_COLUMNS or fmt not in ('csv', 'ndjson'):
+        return jsonify({'error': 'Unknown export'}), 404
+    try:
+        start = parse_export_date(request.args.get('from'))
+        end = parse_export_date(request.args.get('to'), end=True)
+    except ValueError:
+        return jsonify({'error': 'Dates must be YYYY-MM-DD'}), 400
+    rows = export_rows(kind, current_user.id, start, end)
+    mimetype = 'text/csv' if fmt == 'csv' else 'application/x-ndjson'
+    response = Response(stream_with_context(export_stream(kind, fmt, rows)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = f'attachment; filename="{kind}.{fmt}"'
+    return response
+
+# Each source returns (kind, id, patient, snippet, date, rank) for the doctor's own rows
+# Ranking only touches the index (plus the appointment list for medical
+# history, which has no owner column); snippets and patient names are built
+# afterwards for the rows on the requested page. :scoped limits the match to
+# the doctor's owner token, and bm25 gives that column no weight. CROSS JOIN
+# keeps the FTS table as the outer loop: left to itself SQLite may walk the
+# doctor's rows and run the MATCH once per row. Archived rows are kinds of their
+# own, so a hit is always looked up in the table it was ranked from.
+SEARCH_RANK = {
+    'symptoms': """
+        SELECT 'symptoms' AS kind, rowid AS id, bm25(waiting_room_fts, 1.0, 0.0) AS rank
+        FROM waiting_room_fts WHERE waiting_room_fts MATCH :scoped""",
+    'messages': """
+        SELECT 'messages' AS kind, rowid AS id, bm25(message_fts, 1.0, 0.0) AS rank
+        FROM message_fts WHERE message_fts MATCH :scoped""",
+    'history': """
+        SELECT 'history' AS kind, p.id AS id, bm25(patient_fts) AS rank
+        FROM patient_fts CROSS JOIN patient p ON p.id = patient_fts.rowid
+        WHERE patient_fts MATCH :match AND p.id IN (SELECT patient_id FROM appointment WHERE doctor_id = :doctor)""",
+    'archived_symptoms': """
+        SELECT 'archived_symptoms' AS kind, rowid AS id, bm25(archived_consultation_fts, 1.0, 0.0) AS rank
+        FROM archived_consultation_fts WHERE archived_consultation_fts MATCH :scoped""",
+    'archived_messages': """
+        SELECT 'archived_messages' AS kind, rowid AS id, bm25(archived_message_fts, 1.0, 0.0) AS rank
+        FROM archived_message_fts WHERE archived_message_fts MATCH :scoped""",
+}
+# Searching a kind also searches its archive; results show the live kind, flagged as archived
+SEARCH_ARCHIVED = {'archived_symptoms': 'symptoms', 'archived_messages': 'messages'}
+
+# The unary + stops the ids from reaching FTS5 as rowid lookups: each lookup
+# would expand the prefix term again, while one MATCH pass expands it once
+SEARCH_DETAILS = {
+    'symptoms': """
+        SELECT w.id AS id, coalesce(u.name, u.username) AS patient,
+               snippet(waiting_room_fts, 0, '[', ']', '…', 12) AS snippet, w.created_at AS date
+        FROM waiting_room_fts CROSS JOIN waiting_room w ON w.id = waiting_room_fts.rowid JOIN user u ON u.id = w.patient_id
+        WHERE waiting_room_fts MATCH :scoped AND +waiting_room_fts.rowid IN :ids""",
+    'messages': """
+        SELECT m.id AS id, coalesce(u.name, u.username) AS patient,
+               snippet(message_fts, 0, '[', ']', '…', 12) AS snippet, m.timestamp AS date
+        FROM message_fts CROSS JOIN message m ON m.id = message_fts.rowid
+        JOIN user u ON u.id = CASE WHEN m.sender_id = :doctor THEN m.receiver_id ELSE m.sender_id END
+        WHERE message_fts MATCH :scoped AND +message_fts.rowid IN :ids""",
+    'history': """
+        SELECT p.id AS id, p.name AS patient,
+               snippet(patient_fts, 0, '[', ']', '…', 12) AS snippet, NULL AS date
+        FROM patient_fts CROSS JOIN patient p ON p.id = patient_fts.rowid
+        WHERE patient_fts MATCH :match AND +patient_fts.rowid IN :ids""",
+    'archived_symptoms': """
+        SELECT a.id AS id, coalesce(u.name, u.username) AS patient,
+               snippet(archived_consultation_fts, 0, '[', ']', '…', 12) AS snippet, a.created_at AS date
+        FROM archived_consultation_fts CROSS JOIN archived_consultation a ON a.id = archived_consultation_fts.rowid JOIN user u ON u.id = a.patient_id
+        WHERE archived_consultation_fts MATCH :scoped AND +archived_consultation_fts.rowid IN :ids""",
+    'archived_messages': """
+        SELECT a.id AS id, coalesce(u.name, u.username) AS patient,
+               snippet(archived_message_fts, 0, '[', ']', '…', 12) AS snippet, a.timestamp AS date
+        FROM archived_message_fts CROSS JOIN archived_message a ON a.id = archived_message_fts.rowid
+        JOIN user u ON u.id = CASE WHEN a.sender_id = :doctor THEN a.receiver_id ELSE a.sender_id END
+        WHERE archived_message_fts MATCH :scoped AND +archived_message_fts.rowid IN :ids""",
+}
+
+def search_match(terms):
+    # Every word must appear; each is quoted so user input can't break the FTS5
+    # syntax, and the last one also matches as a prefix (search-as-you-type)
+    words = ['"' + word.replace('"', '""') + '"' for word in terms.split()]
+    if words:
+        words[-1] += '*'
+    return ' '.join(words)
+
+def search(doctor_id, terms, kinds, page):
+    page_size = app.config['SEARCH_PAGE_SIZE']
+    match = search_match(terms)
+    # Words never match the owner column, so typing "u12" finds text, not user 12
+    params = {'match': match, 'scoped': f'owner : "u{doctor_id}" AND - owner : ({match})', 'doctor': doctor_id}
+    kinds = list(kinds) + [archived for archived, kind in SEARCH_ARCHIVED.items() if kind in kinds]
+    sql = ' UNION ALL '.join(SEARCH_RANK[kind] for kind in kinds) + ' ORDER BY rank LIMIT :limit OFFSET :offset'
+    ranked = db.session.execute(db.text(sql), {**params, 'limit': page_size + 1, 'offset': (page - 1) * page_size}).all()
+    page_rows = ranked[:page_size]
+    details = {}
+    for kind in {row.kind for row in page_rows}:
+        query = db.text(SEARCH_DETAILS[kind]).bindparams(db.bindparam('ids', expanding=True)).columns(date=db.DateTime)
+        ids = [row.id for row in page_rows if row.kind == kind]
+        for row in db.session.execute(query, {**params, 'ids': ids}).mappings():
+            details[kind, row['id']] = row
+    items = []
+    for row in page_rows:
+        found = details.get((row.kind, row.id))
+        if not found:
+            continue  # deleted since it was ranked
+        items.append({
+            'kind': SEARCH_ARCHIVED.get(row.kind, row.kind),
+            'id': row.id,
+            'patient': found['patient'],
+            'snippet': found['snippet'],
+            'date': found['date'].isoformat() if found['date'] else None,
+            'archived': row.kind in SEARCH_ARCHIVED,
+        })
+    return items, page + 1 if len(ranked) > page_size else None
+
+@app.route('/api/search')
+@login_required
+def api_search():
+    if current_user.role != 'doctor':
+        return jsonify({'error': 'Not a doctor'}), 403
+    if db.engine.dialect.name != 'sqlite':
+        return jsonify({'error': 'La búsqueda necesita SQLite con FTS5'}), 501
+    terms = (request.args.get('q') or '').strip()
+    if not terms:
+        return jsonify({'error': 'Falta el texto a buscar'}), 400
+    searchable = [kind for kind in SEARCH_RANK if kind not in SEARCH_ARCHIVED]
+    kinds = [kind for kind in request.args.get('kind', '').split(',') if kind in searchable] or searchable
+    page = max(request.args.get('page', 1, type=int), 1)
+    items, next_page = search(current_user.id, terms, kinds, page)
+    return jsonify({'items': items, 'next_page': next_page})
+
 @app.route('/profile', methods=['GET', 'POST'])
 @login_required
 def profile():
     if request.method == 'POST':
-        current_user.name = request.form.get('name')
-        current_user.description = request.form.get('description')
-        if current_user.role == 'doctor':
-            current_user.specialty = request.form.get('specialty')
         new_password = request.form.get('password')
-        if new_password:
-            current_user.password = generate_password_hash(new_password, method='pbkdf2:sha256')
+        try:
+            hashed_password = password_hasher.hash(new_password) if new_password else None
+        except HashingBusy:
+            flash('El servidor está ocupado, intentá de nuevo en unos segundos.')
+            return render_template('profile.html'), 503, {'Retry-After': '1'}
+        user = fresh_current_user()
+        user.name = request.form.get('name')
+        user.description = request.form.get('description')
+        if user.role == 'doctor':
+            user.specialty = request.form.get('specialty')
+        if hashed_password:
+            user.password = hashed_password
+        user_id = user.id
+        is_doctor = user.role == 'doctor'
         db.session.commit()
+        user_cache.invalidate(user_id)
+        if is_doctor:
+            doctor_directory.invalidate()
         flash('Perfil actualizado.', 'success')
         return redirect(url_for('profile'))
     return render_template('profile.html')
@@ -394,11 +1963,9 @@ def update_queue_order():
     if current_user.role != 'doctor':
         return jsonify({'error': 'Not authorized'}), 403
     data = request.get_json()
-    order_ids = data.get('order', [])
-    for index, waiting_id in enumerate(order_ids):
-        waiting = WaitingRoom.query.get(waiting_id)
-        if waiting and waiting.doctor_id == current_user.id and waiting.status == 'pending':
-            waiting.queue_order = index + 1
+    order_ids = [int(waiting_id) for waiting_id in data.get('order', [])]
+    # One UPDATE; rows that are not this doctor's pending requests are left alone
+    queue_ordering.reorder(current_user.id, order_ids)
     db.session.commit()
     return jsonify({'success': True})
 
@@ -410,11 +1977,7 @@ def move_up(id):
     waiting = WaitingRoom.query.get(id)
     if not waiting or waiting.doctor_id != current_user.id or waiting.status not in ['accepted', 'in_room']:
         return jsonify({'error': 'Invalid request'}), 400
-    prev = WaitingRoom.query.filter(WaitingRoom.doctor_id == current_user.id, WaitingRoom.status.in_(['accepted', 'in_room']), WaitingRoom.queue_order < waiting.queue_order).order_by(WaitingRoom.queue_order.desc()).first()
-    if prev:
-        temp = waiting.queue_order
-        waiting.queue_order = prev.queue_order
-        prev.queue_order = temp
+    if queue_ordering.move(waiting, ACTIVE, up=True):
         db.session.commit()
     return jsonify({'success': True})
 
@@ -426,11 +1989,7 @@ def move_down(id):
     waiting = WaitingRoom.query.get(id)
     if not waiting or waiting.doctor_id != current_user.id or waiting.status not in ['accepted', 'in_room']:
         return jsonify({'error': 'Invalid request'}), 400
-    next_ = WaitingRoom.query.filter(WaitingRoom.doctor_id == current_user.id, WaitingRoom.status.in_(['accepted', 'in_room']), WaitingRoom.queue_order > waiting.queue_order).order_by(WaitingRoom.queue_order).first()
-    if next_:
-        temp = waiting.queue_order
-        waiting.queue_order = next_.queue_order
-        next_.queue_order = temp
+    if queue_ordering.move(waiting, ACTIVE, up=False):
         db.session.commit()
     return jsonify({'success': True})
 
@@ -439,15 +1998,10 @@ def move_down(id):
 def api_queue_position():
     if current_user.role != 'patient':
         return jsonify({'position': None})
-    pending = WaitingRoom.query.filter_by(patient_id=current_user.id, status='pending').order_by(WaitingRoom.queue_order).first()
-    if not pending:
+    queued = queue_index.position(current_user.id)
+    if not queued:
         return jsonify({'position': None})
-    position = db.session.query(func.count(WaitingRoom.id)).filter(
-        WaitingRoom.doctor_id == pending.doctor_id,
-        WaitingRoom.status == 'pending',
-        WaitingRoom.queue_order < pending.queue_order
-    ).scalar() + 1
-    return jsonify({'position': position})
+    return jsonify({'position': queued[2]})
 
 @app.route('/api/active_consultations')
 @login_required
@@ -471,8 +2025,9 @@ def api_active_consultations():
 def api_waiting_requests():
     if current_user.role != 'doctor':
         return jsonify([])
-    pending = WaitingRoom.query.filter_by(doctor_id=current_user.id, status='pending').order_by(WaitingRoom.queue_order).all()
-    accepted = WaitingRoom.query.filter_by(doctor_id=current_user.id).filter(WaitingRoom.status.in_(['accepted', 'in_room'])).order_by(WaitingRoom.queue_order).all()
+    with_patient = WaitingRoom.query.options(selectinload(WaitingRoom.patient))
+    pending = with_patient.filter_by(doctor_id=current_user.id, status='pending').order_by(WaitingRoom.queue_order).all()
+    accepted = with_patient.filter_by(doctor_id=current_user.id).filter(WaitingRoom.status.in_(['accepted', 'in_room'])).order_by(WaitingRoom.queue_order).all()
     return jsonify({
         'pending': [{'id': w.id, 'patient_name': w.patient.name or w.patient.username, 'symptoms': w.symptoms} for w in pending],
         'accepted': [{'id': w.id, 'patient_name': w.patient.name or w.patient.username, 'status': w.status} for w in accepted]
@@ -481,21 +2036,41 @@ def api_waiting_requests():
 @app.route('/api/chat_messages/<int:user_id>')
 @login_required
 def api_chat_messages(user_id):
-    messages = Message.query.filter(
-        ((Message.sender_id == current_user.id) & (Message.receiver_id == user_id)) |
-        ((Message.sender_id == user_id) & (Message.receiver_id == current_user.id))
-    ).order_by(Message.timestamp.asc()).all()
-    # Mark messages from user_id as read
-    for m in messages:
-        if m.sender_id == user_id and m.receiver_id == current_user.id:
-            m.read = True
-    db.session.commit()
-    return jsonify([{
+    # ?since_id=N returns messages newer than N, ?before_id=N the page older than N;
+    # without a cursor the most recent page is returned
+    since_id = request.args.get('since_id', type=int)
+    before_id = request.args.get('before_id', type=int)
+    page_size = app.config['CHAT_PAGE_SIZE']
+    conversation = conversation_query(current_user.id, user_id)
+    if before_id:
+        messages = conversation.filter(Message.id < before_id).order_by(Message.id.desc()).limit(page_size).all()
+        messages.reverse()
+    else:
+        latest_id = conversation.with_entities(func.max(Message.id)).scalar() or 0
+        etag = f"{since_id or 0}-{latest_id}"
+        if request.if_none_match.contains_weak(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
+        if since_id:
+            messages = conversation.filter(Message.id > since_id).order_by(Message.id).all()
+        else:
+            messages = conversation.order_by(Message.id.desc()).limit(page_size).all()
+            messages.reverse()
+    data = [{
         'id': m.id,
         'sender_id': m.sender_id,
         'content': m.content,
         'timestamp': m.timestamp.strftime('%H:%M')
-    } for m in messages])
+    } for m in messages]
+    # Mark messages from user_id as read
+    if not before_id and any(m['sender_id'] == user_id for m in data):
+        mark_conversation_read(current_user.id, user_id)
+    response = jsonify(data)
+    if not before_id:
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/api/unread_count')
 @login_required
@@ -511,30 +2086,252 @@ def api_latest_unread_message():
         return jsonify({'message': {'content': message.content, 'sender': message.sender.username}})
     return jsonify({'message': None})
 
-@app.route('/migrate_db')
-def migrate_db():
-    try:
-        db.session.execute(db.text('ALTER TABLE waiting_room ADD COLUMN feedback_submitted BOOLEAN DEFAULT 0'))
-        db.session.commit()
-        return 'Migration completed'
-    except Exception as e:
-        return f'Error: {e}'
+def live_status(user_id, role):
+    # Unread count and newest unread message (with its sender) in one query
+    row = db.session.query(Message.id, Message.content, User.username, func.count().over()).join(User, User.id == Message.sender_id).filter(Message.receiver_id == user_id, Message.read == False).order_by(Message.timestamp.desc()).first()
+    unread = row[3] if row else 0
+    latest = {'id': row[0], 'content': row[1], 'sender': row[2]} if row else None
+    position = None
+    queue_doctor_id = None
+    if role == 'doctor':
+        waitings = WaitingRoom.query.filter_by(doctor_id=user_id).filter(WaitingRoom.status.in_(['accepted', 'in_room'])).order_by(WaitingRoom.queue_order).all()
+    else:
+        waitings = WaitingRoom.query.filter_by(patient_id=user_id).filter(WaitingRoom.status.in_(['accepted', 'in_room'])).all()
+        queued = queue_index.position(user_id)
+        if queued:
+            queue_doctor_id, position = queued[1], queued[2]
+    consultations = [{
+        'id': w.id,
+        'other_user_id': w.patient_id if role == 'doctor' else w.doctor_id,
+        'status': w.status,
+        'queue_order': w.queue_order
+    } for w in waitings]
+    return {'unread': unread, 'latest': latest, 'position': position, 'consultations': consultations}, queue_doctor_id
+
+@app.route('/api/snapshot')
+@login_required
+def api_snapshot():
+    # Everything the status widgets show, in one request. The version is a
+    # digest of the content, so it also matches across worker processes; send
+    # it back as If-None-Match to get an empty 304 when nothing changed.
+    status, _ = live_status(current_user.id, current_user.role)
+    body = json.dumps(status, sort_keys=True)
+    version = hashlib.sha1(body.encode()).hexdigest()[:16]
+    if request.if_none_match.contains_weak(version):
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(version)
+    return response
+
+def _sse(event_name, data):
+    return f"event: {event_name}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/api/events')
+@login_required
+def api_events():
+    if not app.config['EVENTS_ENABLED']:
+        # EventSource doesn't reconnect after a 204; the pages poll /api/snapshot
+        return Response(status=204)
+    user_id = current_user.id
+    role = current_user.role
+    heartbeat = app.config['EVENTS_HEARTBEAT']
+    max_age = app.config['EVENTS_MAX_AGE']
+
+    def stream():
+        started = time.monotonic()
+        sent = {}
+        keys = [('user', user_id)]
+        yield f"retry: {heartbeat * 1000}\n\n"
+        while time.monotonic() - started < max_age:
+            # Take the versions before reading so a commit in between is not missed
+            seen = live_events.version(keys)
+            status, queue_doctor_id = live_status(user_id, role)
+            # End the read transaction so the stream never holds a SQLite lock while idle
+            db.session.rollback()
+            changed = False
+            if status['unread'] != sent.get('unread'):
+                yield _sse('unread', {'unread': status['unread']})
+                changed = True
+            latest = status['latest']
+            if latest and latest['id'] != sent.get('latest_id'):
+                yield _sse('new_message', {'message': latest})
+                sent['latest_id'] = latest['id']
+                changed = True
+            if role == 'patient' and status['position'] != sent.get('position', 0):
+                yield _sse('queue_position', {'position': status['position']})
+                changed = True
+            if status['consultations'] != sent.get('consultations'):
+                yield _sse('consultation_status', {'consultations': status['consultations']})
+                changed = True
+            if not changed and sent:
+                yield ": keepalive\n\n"
+            sent.update(unread=status['unread'], position=status['position'], consultations=status['consultations'])
+            new_keys = [('user', user_id)] + ([('queue', queue_doctor_id)] if queue_doctor_id else [])
+            if new_keys != keys:
+                keys = new_keys
+                continue
+            # Wakes on a committed change to this user's rows, or re-checks after the
+            # heartbeat so changes made by other worker processes are still picked up
+            live_events.wait(keys, seen, heartbeat)
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/api/appointments', methods=['GET'])
 @login_required
 def api_appointments():
-    appointments = Appointment.query.all()
-    return jsonify([{'id': a.id, 'patient_name': a.patient.name, 'doctor_name': a.doctor.username, 'date': a.date.isoformat(), 'reason': a.reason} for a in appointments])
-    appointments = Appointment.query.all()
-    return jsonify([{'id': a.id, 'patient_name': a.patient.name, 'doctor_name': a.doctor.username, 'date': a.date.isoformat(), 'reason': a.reason} for a in appointments])
+    appointments, next_cursor = appointments_page(request.args.get('after'))
+    return jsonify({
+        'appointments': [{'id': a.id, 'patient_name': a.patient.name, 'doctor_name': a.doctor.username, 'date': a.date.isoformat(), 'reason': a.reason} for a in appointments],
+        'next_cursor': next_cursor
+    })
 
-if __name__ == '__main__':
-    with app.app_context():
+# Versioned schema migrations: each step takes the database from the previous
+# version to its own and is recorded in schema_migration, so startup only has to
+# compare versions. Steps still check what is already there, since databases
+# from before versioning start at 0 with some of the changes made by hand.
+# Backfills commit every batch_size rows, so the app keeps writing meanwhile.
+
+def add_column(table, column, ddl):
+    # A constant default is taken by existing rows without rewriting the table
+    if column in {c['name'] for c in db.inspect(db.engine).get_columns(table)}:
+        return False
+    db.session.execute(db.text(f'ALTER TABLE {db.engine.dialect.identifier_preparer.quote(table)} ADD COLUMN {ddl}'))
+    db.session.commit()
+    return True
+
+def create_index(index):
+    # Postgres builds it without blocking writes; SQLite has no online build,
+    # so each index at least gets a transaction of its own
+    ddl = str(CreateIndex(index, if_not_exists=True).compile(dialect=db.engine.dialect))
+    if db.engine.dialect.name == 'postgresql':
+        ddl = ddl.replace(' INDEX ', ' INDEX CONCURRENTLY ', 1)
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+        connection.exec_driver_sql(ddl)
+
+def rebuild_autoincrement(model, archive, references=()):
+    # SQLite reuses the id of a deleted newest row unless the table is
+    # AUTOINCREMENT, and archive_data.py deletes rows whose ids the archive keeps.
+    # Rebuild the table as AUTOINCREMENT in one transaction, move live rows that
+    # already took an archived id to new ids (with the (table, column) pairs in
+    # references that point at them), and start the sequence past both tables.
+    table = model.__tablename__
+    with db.engine.begin() as connection:
+        ddl = connection.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).scalar()
+        if 'AUTOINCREMENT' in ddl.upper():
+            return
+        columns = ', '.join(connection.dialect.identifier_preparer.quote(column.name) for column in model.__table__.columns)
+        create = str(CreateTable(model.__table__).compile(dialect=connection.dialect))
+        connection.exec_driver_sql(f'DROP VIEW IF EXISTS {table}_search')  # would block the rename
+        connection.exec_driver_sql(create.replace(f'CREATE TABLE {table} (', f'CREATE TABLE {table}_rebuild (', 1))
+        connection.exec_driver_sql(f'INSERT INTO {table}_rebuild ({columns}) SELECT {columns} FROM {table}')
+        connection.exec_driver_sql(f'DROP TABLE {table}')
+        connection.exec_driver_sql(f'ALTER TABLE {table}_rebuild RENAME TO {table}')
+        for index in model.__table__.indexes:
+            connection.exec_driver_sql(str(CreateIndex(index).compile(dialect=connection.dialect)))
+        last_id = connection.exec_driver_sql(f'SELECT max(coalesce((SELECT max(id) FROM {table}), 0), coalesce((SELECT max(id) FROM {archive}), 0))').scalar()
+        reused = [row[0] for row in connection.exec_driver_sql(f'SELECT id FROM {table} WHERE id IN (SELECT id FROM {archive}) ORDER BY id')]
+        for old_id in reused:
+            last_id += 1
+            connection.exec_driver_sql(f'UPDATE {table} SET id = ? WHERE id = ?', (last_id, old_id))
+            for other, column in references:
+                connection.exec_driver_sql(f'UPDATE {other} SET {column} = ? WHERE {column} = ?', (last_id, old_id))
+        connection.exec_driver_sql('DELETE FROM sqlite_sequence WHERE name = ?', (table,))
+        connection.exec_driver_sql('INSERT INTO sqlite_sequence (name, seq) VALUES (?, ?)', (table, last_id))
+        _create_search_index(db.metadata, connection)
+        if reused:
+            connection.exec_driver_sql(f"INSERT INTO {table}_fts({table}_fts) VALUES ('rebuild')")
+
+def migrate_message_read(batch_size, pause):
+    add_column('message', 'read', 'read BOOLEAN DEFAULT FALSE')
+
+def migrate_waiting_room_flags(batch_size, pause):
+    add_column('waiting_room', 'feedback_submitted', 'feedback_submitted BOOLEAN DEFAULT FALSE')
+    add_column('waiting_room', 'chat_enabled', 'chat_enabled BOOLEAN DEFAULT FALSE')
+
+def migrate_rating_totals(batch_size, pause):
+    added = add_column('user', 'rating_sum', 'rating_sum INTEGER NOT NULL DEFAULT 0')
+    added = add_column('user', 'rating_count', 'rating_count INTEGER NOT NULL DEFAULT 0') or added
+    if added:
+        rebuild_rating_totals(batch_size, pause)
+
+def migrate_call_sessions(batch_size, pause):
+    if not db.inspect(db.engine).has_table('call_session'):
+        CallSession.__table__.create(db.engine)
+        backfill_call_sessions(batch_size, pause)
+
+def migrate_archive_tables(batch_size, pause):
+    for model in (ArchivedConsultation, ArchivedMessage, Notification):
+        model.__table__.create(db.engine, checkfirst=True)
+
+def migrate_search_index(batch_size, pause):
+    with db.engine.begin() as connection:
+        _create_search_index(db.metadata, connection)
+
+def migrate_indexes(batch_size, pause):
+    # The unique queue indexes need duplicate keys spread out first
+    queue_ordering.renumber_duplicates()
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            create_index(index)
+
+def migrate_autoincrement_ids(batch_size, pause):
+    # Server databases never reuse sequence values
+    if db.engine.dialect.name == 'sqlite':
+        rebuild_autoincrement(WaitingRoom, 'archived_consultation', [('call_session', 'waiting_id')])
+        rebuild_autoincrement(Message, 'archived_message')
+
+MIGRATIONS = [
+    (1, 'message read flag', migrate_message_read),
+    (2, 'waiting room feedback and chat flags', migrate_waiting_room_flags),
+    (3, 'doctor rating totals', migrate_rating_totals),
+    (4, 'call sessions', migrate_call_sessions),
+    (5, 'archive and outbox tables', migrate_archive_tables),
+    (6, 'search index', migrate_search_index),
+    (7, 'indexes', migrate_indexes),
+    (8, 'archive search index', migrate_search_index),
+    (9, 'never reuse archived ids', migrate_autoincrement_ids),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def schema_version():
+    # None for an empty database, 0 for one from before versioned migrations
+    inspector = db.inspect(db.engine)
+    if inspector.has_table('schema_migration'):
+        return db.session.query(func.coalesce(func.max(SchemaMigration.version), 0)).scalar()
+    return 0 if inspector.has_table('user') else None
+
+def migrate_schema(target=None, batch_size=None, pause=None):
+    # Apply the migrations after the database's version up to target (default
+    # the latest) and return the versions applied
+    target = SCHEMA_VERSION if target is None else target
+    batch_size = batch_size or app.config['MIGRATION_BATCH_SIZE']
+    pause = app.config['MIGRATION_BATCH_PAUSE'] if pause is None else pause
+    current = schema_version()
+    if current is None:
+        # Empty database: create the current schema and record it as up to date
         db.create_all()
-        # Add missing columns if needed
-        try:
-            db.session.execute(db.text('ALTER TABLE waiting_room ADD COLUMN feedback_submitted BOOLEAN DEFAULT 0'))
+        db.session.add_all([SchemaMigration(version=version, name=name) for version, name, _ in MIGRATIONS])
+        db.session.commit()
+        return []
+    SchemaMigration.__table__.create(db.engine, checkfirst=True)
+    applied = []
+    for version, name, step in MIGRATIONS:
+        if current < version <= target:
+            app.logger.info('Applying schema migration %s: %s', version, name)
+            step(batch_size, pause)
+            db.session.add(SchemaMigration(version=version, name=name))
             db.session.commit()
-        except:
-            pass  # Column already exists
-    app.run(debug=True)
\ No newline at end of file
+            applied.append(version)
+    return applied
+
+if __name__ == '__main__':
+    with app.app_context():
+        # The development server brings its own database up to date; deployments
+        # run migrate_db.py before starting the new code
+        version = schema_version()
+        if version is None or version < SCHEMA_VERSION:
+            migrate_schema()
+        queue_index.rebuild()
+    notification_outbox.start()  # deliver anything left from a previous run
+    app.run(debug=True)
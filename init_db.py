@@ -1,16 +1,13 @@
-from flask_app import app, db
+from flask_app import app, db, migrate_schema
 from werkzeug.security import generate_password_hash
-from sqlalchemy import text
-import os
 
 with app.app_context():
-    # Si la base de datos existe, eliminarla para recrear con el esquema actualizado
-    db_path = 'medicapp.db'
-    if os.path.exists(db_path):
-        os.remove(db_path)
-        print("Removed old database")
+    # Borrar las tablas de la base configurada (DATABASE_URL) para recrearlas con el esquema actualizado
+    print(f"Database: {db.engine.url.render_as_string(hide_password=True)}")
+    db.drop_all()
+    print("Dropped old tables")
 
-    db.create_all()
+    migrate_schema()  # creates the current schema, recorded as up to date
 
     # Crear usuarios por defecto
     from flask_app import User
@@ -20,7 +17,7 @@ with app.app_context():
         {'username': 'paciente', 'password': 'paciente', 'role': 'patient', 'name': 'María García', 'description': 'Paciente regular en consultas médicas.', 'specialty': None, 'on_shift': False}
     ]
     for user_data in users:
-        hashed_password = generate_password_hash(user_data['password'], method='pbkdf2:sha256')
+        hashed_password = generate_password_hash(user_data['password'], method=app.config['PASSWORD_HASH_METHOD'])
         user = User(
             username=user_data['username'],
             password=hashed_password,
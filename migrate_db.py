@@ -1,18 +1,49 @@
-from flask_app import db, app
+import argparse
+import logging
+import time
 
-with app.app_context():
-    # Add read column to message table if not exists
-    try:
-        db.engine.execute(db.text("ALTER TABLE message ADD COLUMN read BOOLEAN DEFAULT 0"))
-        print("Added 'read' column to message table")
-    except Exception as e:
-        print(f"Column 'read' might already exist: {e}")
+from flask_app import app, MIGRATIONS, SCHEMA_VERSION, SchemaMigration, schema_version, migrate_schema
 
-    # Add feedback_submitted column to waiting_room table if not exists
-    try:
-        db.engine.execute(db.text("ALTER TABLE waiting_room ADD COLUMN feedback_submitted BOOLEAN DEFAULT 0"))
-        print("Added 'feedback_submitted' column to waiting_room table")
-    except Exception as e:
-        print(f"Column 'feedback_submitted' might already exist: {e}")
+# Brings the database schema up to date with the versioned migrations in
+# flask_app.py (MIGRATIONS) and records each one in schema_migration. Safe to
+# run while the app is serving: backfills commit every --batch-size rows. An
+# empty database gets the whole current schema at once.
+#
+#   python migrate_db.py                 # apply every pending migration
+#   python migrate_db.py --status        # show the applied and pending migrations
+#   python migrate_db.py --to 4 --batch-size 500 --pause 0.1
 
-print("Migration completed")
\ No newline at end of file
+parser = argparse.ArgumentParser(description='Apply pending schema migrations')
+parser.add_argument('--status', action='store_true', help='only list applied and pending migrations')
+parser.add_argument('--to', type=int, help=f'stop at this version (default {SCHEMA_VERSION}, the latest)')
+parser.add_argument('--batch-size', type=int, help='rows per transaction in backfills (default MIGRATION_BATCH_SIZE)')
+parser.add_argument('--pause', type=float, help='seconds to sleep between batches (default MIGRATION_BATCH_PAUSE)')
+
+
+def status(version):
+    applied = {row.version: row.applied_at for row in SchemaMigration.query} if version else {}
+    print(f"Schema version {version if version is not None else '- (empty database)'}, latest {SCHEMA_VERSION}")
+    for number, name, _ in MIGRATIONS:
+        if number in applied:
+            state = f"applied {applied[number]:%Y-%m-%d %H:%M}"
+        else:
+            state = 'pending'
+        print(f"  {number:>3}  {name:40} {state}")
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    app.logger.setLevel(logging.INFO)
+    with app.app_context():
+        version = schema_version()
+        if args.status:
+            status(version)
+        elif version is not None and version >= (args.to or SCHEMA_VERSION):
+            print(f"Schema already at version {version}")
+        else:
+            started = time.perf_counter()
+            applied = migrate_schema(args.to, args.batch_size, args.pause)
+            if version is None:
+                print(f"Created the schema at version {SCHEMA_VERSION} in {time.perf_counter() - started:.1f}s")
+            else:
+                print(f"Applied {len(applied)} migrations, now at version {schema_version()}, in {time.perf_counter() - started:.1f}s")
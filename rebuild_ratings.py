@@ -0,0 +1,6 @@
+from flask_app import app, rebuild_rating_totals
+
+# Backfill or repair the per-doctor rating totals used by /guardias
+with app.app_context():
+    updated = rebuild_rating_totals()
+    print(f"Rating totals rebuilt for {updated} doctors")
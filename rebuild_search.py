@@ -0,0 +1,13 @@
+import time
+
+from flask_app import app, db, rebuild_search_index
+
+# Rebuild the SQLite full-text search indexes (symptoms, messages, medical
+# history, archived symptoms and messages) from their tables, if one is ever
+# suspected to be out of sync, and merge their segments after large bulk loads.
+# Missing indexes are created and filled by create_all().
+with app.app_context():
+    db.create_all()
+    started = time.perf_counter()
+    rebuild_search_index()
+    print(f"Search indexes rebuilt in {time.perf_counter() - started:.1f}s")
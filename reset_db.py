@@ -1,9 +1,9 @@
-from flask_app import db, app, User
+from flask_app import db, app, User, migrate_schema
 from werkzeug.security import generate_password_hash
 
 with app.app_context():
     db.drop_all()
-    db.create_all()
+    migrate_schema()  # creates the current schema, recorded as up to date
 
     # Create default users
     default_users = [
@@ -13,7 +13,7 @@ with app.app_context():
     ]
 
     for user_data in default_users:
-        hashed_password = generate_password_hash(user_data['password'], method='pbkdf2:sha256')
+        hashed_password = generate_password_hash(user_data['password'], method=app.config['PASSWORD_HASH_METHOD'])
         user = User(
             username=user_data['username'],
             password=hashed_password,
@@ -0,0 +1,70 @@
+// Shared by the logged-in pages: side menu, unread badge with its sound and the
+// incoming video call prompt (templates/video_call_modal.html). Load after live.js.
+function toggleMenu() {
+    document.getElementById('menu').classList.toggle('open');
+}
+
+function playNotificationSound() {
+    // Simple beep using Web Audio API
+    const audioContext = new (window.AudioContext || window.webkitAudioContext)();
+    const oscillator = audioContext.createOscillator();
+    const gainNode = audioContext.createGain();
+    oscillator.connect(gainNode);
+    gainNode.connect(audioContext.destination);
+    oscillator.frequency.value = 800;
+    oscillator.type = 'square';
+    gainNode.gain.setValueAtTime(0.3, audioContext.currentTime);
+    oscillator.start(audioContext.currentTime);
+    oscillator.stop(audioContext.currentTime + 0.2);
+}
+
+function showVideoCallModal(caller) {
+    const modal = document.getElementById('videoCallModal');
+    if (!modal) return;
+    document.getElementById('callerName').textContent = caller;
+    modal.style.display = 'block';
+}
+
+function closeVideoCallModal() {
+    document.getElementById('videoCallModal').style.display = 'none';
+}
+
+function joinIncomingCall() {
+    // Pages that must stay open (the guardia queue) open the chat in a new tab
+    if (document.getElementById('videoCallModal').dataset.newTab) {
+        window.open('/messages', '_blank');
+    } else {
+        window.location.href = '/messages';
+    }
+    closeVideoCallModal();
+}
+
+let lastUnread = 0;
+function updateUnreadBadge(data) {
+    const badge = document.getElementById('unread-badge');
+    if (badge) {
+        if (data.unread > 0) {
+            badge.textContent = data.unread > 99 ? '99+' : data.unread;
+            badge.style.display = 'inline';
+            if (data.unread > lastUnread) {
+                playNotificationSound();
+            }
+        } else {
+            badge.style.display = 'none';
+        }
+    }
+    lastUnread = data.unread;
+}
+
+function startPageUpdates(handlers = {}) {
+    // Badge and call prompt, plus any page-specific handlers
+    startLiveUpdates({
+        unread: updateUnreadBadge,
+        new_message(data) {
+            if (data.message && data.message.content.includes('Videollamada')) {
+                showVideoCallModal(data.message.sender);
+            }
+        },
+        ...handlers,
+    });
+}
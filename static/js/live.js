@@ -0,0 +1,65 @@
+// Live status updates for the menu badge, queue position and consultations.
+// Uses the /api/events stream and falls back to polling /api/snapshot when
+// EventSource is not available, the server has the stream disabled (it answers
+// 204, which closes the source) or the stream keeps failing.
+const LIVE_POLL_INTERVAL = 3000;
+const LIVE_MAX_STREAM_ERRORS = 3;
+
+function startLiveUpdates(handlers) {
+    if (!window.EventSource) {
+        startLivePolling(handlers);
+        return;
+    }
+    const source = new EventSource('/api/events');
+    let errors = 0;
+    ['unread', 'new_message', 'queue_position', 'consultation_status'].forEach(type => {
+        source.addEventListener(type, e => {
+            errors = 0;
+            if (handlers[type]) {
+                handlers[type](JSON.parse(e.data));
+            }
+        });
+    });
+    source.onerror = () => {
+        errors += 1;
+        if (source.readyState === EventSource.CLOSED || errors >= LIVE_MAX_STREAM_ERRORS) {
+            console.log('Event stream unavailable, falling back to polling');
+            source.close();
+            startLivePolling(handlers);
+        }
+    };
+}
+
+function startLivePolling(handlers) {
+    // One /api/snapshot request per interval; an unchanged snapshot is a 304
+    let version = null;
+    let last = null;
+
+    function poll() {
+        const headers = version ? { 'If-None-Match': version } : {};
+        fetch('/api/snapshot', { headers })
+            .then(r => {
+                if (r.status === 304) return null;
+                version = r.headers.get('ETag');
+                return r.json();
+            })
+            .then(data => {
+                if (!data) return;
+                if (!last || data.unread !== last.unread) {
+                    if (handlers.unread) handlers.unread({ unread: data.unread });
+                }
+                if (data.latest && (!last || !last.latest || data.latest.id !== last.latest.id)) {
+                    if (handlers.new_message) handlers.new_message({ message: data.latest });
+                }
+                if (!last || data.position !== last.position) {
+                    if (handlers.queue_position) handlers.queue_position({ position: data.position });
+                }
+                if (!last || JSON.stringify(data.consultations) !== JSON.stringify(last.consultations)) {
+                    if (handlers.consultation_status) handlers.consultation_status({ consultations: data.consultations });
+                }
+                last = data;
+            }).catch(e => console.log('Snapshot polling error', e));
+    }
+    setInterval(poll, LIVE_POLL_INTERVAL);
+    poll();
+}
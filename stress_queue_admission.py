@@ -0,0 +1,150 @@
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Concurrency check for queue admission: several worker processes admit patients
+# to the same doctors while others accept, reorder and move entries, the way
+# gunicorn workers would during a busy shift. Afterwards every doctor's pending
+# and accepted queues must hold unique keys, so positions run 1..n with no
+# duplicates or holes, and no admission may have been lost.
+#
+#   python stress_queue_admission.py --workers 8 --admissions 100
+#   python stress_queue_admission.py --url postgresql+psycopg2://medicapp@localhost/medicapp_stress
+
+parser = argparse.ArgumentParser(description='Stress test queue admission')
+parser.add_argument('--workers', type=int, default=8, help='patient processes')
+parser.add_argument('--admissions', type=int, default=100, help='admissions per patient process')
+parser.add_argument('--doctors', type=int, default=2)
+parser.add_argument('--url', help='database URI to test instead of a temporary SQLite file')
+args = parser.parse_args()
+
+
+def setup(url, workers, doctors):
+    os.environ['DATABASE_URL'] = url
+    from flask_app import app, db, User
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        for i in range(doctors):
+            db.session.add(User(username=f'stress_doc{i}', password='-', role='doctor', name=f'Doctor {i}', on_shift=True))
+        for i in range(workers):
+            db.session.add(User(username=f'stress_pac{i}', password='-', role='patient', name=f'Paciente {i}'))
+        db.session.commit()
+
+
+def patient_worker(url, index, admissions, doctor_ids, start, results):
+    os.environ['DATABASE_URL'] = url
+    from flask_app import app, db, User, queue_ordering
+    rng = random.Random(index)
+    admitted, errors = {}, 0
+    with app.app_context():
+        patient_id = User.query.filter_by(username=f'stress_pac{index}').one().id
+        start.wait()
+        for i in range(admissions):
+            doctor_id = rng.choice(doctor_ids)
+            try:
+                queue_ordering.admit(patient_id, doctor_id, f'Sintoma {i}')
+                admitted[doctor_id] = admitted.get(doctor_id, 0) + 1
+            except Exception:
+                db.session.rollback()
+                errors += 1
+    results.put(('patient', admitted, errors))
+
+
+def doctor_worker(url, doctor_id, start, stop, results):
+    os.environ['DATABASE_URL'] = url
+    from flask_app import app, db, WaitingRoom, queue_ordering, ACTIVE
+    rng = random.Random(doctor_id)
+    accepted = errors = 0
+    with app.app_context():
+        start.wait()
+        while not stop.is_set():
+            try:
+                pending = [row.id for row in db.session.query(WaitingRoom.id).filter_by(doctor_id=doctor_id, status='pending').order_by(WaitingRoom.queue_order)]
+                action = rng.random()
+                if pending and action < 0.5:
+                    waiting = db.session.get(WaitingRoom, pending[0])
+                    if queue_ordering.accept(waiting.id, doctor_id, waiting.patient_id):
+                        accepted += 1
+                elif len(pending) > 2 and action < 0.7:
+                    rng.shuffle(pending)
+                    queue_ordering.reorder(doctor_id, pending)
+                    db.session.commit()
+                else:
+                    active = db.session.query(WaitingRoom).filter(WaitingRoom.doctor_id == doctor_id, WaitingRoom.status.in_(ACTIVE)).all()
+                    if len(active) > 1 and queue_ordering.move(rng.choice(active), ACTIVE, up=rng.random() < 0.5):
+                        db.session.commit()
+                    else:
+                        db.session.rollback()
+            except Exception:
+                db.session.rollback()
+                errors += 1
+            db.session.expire_all()
+    results.put(('doctor', {doctor_id: accepted}, errors))
+
+
+def verify(url, admitted):
+    os.environ['DATABASE_URL'] = url
+    from flask_app import app, db, WaitingRoom, queue_index, PENDING, ACTIVE
+    problems = []
+    with app.app_context():
+        for doctor_id, expected in sorted(admitted.items()):
+            total = WaitingRoom.query.filter_by(doctor_id=doctor_id).count()
+            if total != expected:
+                problems.append(f"doctor {doctor_id}: {expected} admissions but {total} rows")
+            for label, statuses in (('pending', PENDING), ('accepted', ACTIVE)):
+                keys = [row.queue_order for row in db.session.query(WaitingRoom.queue_order).filter(WaitingRoom.doctor_id == doctor_id, WaitingRoom.status.in_(statuses))]
+                if len(keys) != len(set(keys)):
+                    problems.append(f"doctor {doctor_id}: duplicate {label} keys")
+                print(f"doctor {doctor_id}: {len(keys):>5} {label}")
+        # Positions as patients see them: each pending request's rank in its queue
+        queue_index.rebuild()
+        positions = {}
+        for waiting in WaitingRoom.query.filter_by(status='pending'):
+            order = queue_index._queues[waiting.doctor_id]
+            positions.setdefault(waiting.doctor_id, []).append(order.index((waiting.queue_order, waiting.id)) + 1)
+        for doctor_id, ranks in positions.items():
+            if sorted(ranks) != list(range(1, len(ranks) + 1)):
+                problems.append(f"doctor {doctor_id}: positions are not 1..{len(ranks)}")
+    return problems
+
+
+if __name__ == '__main__':
+    url = args.url or 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'stress_queue.db')
+    process = multiprocessing.Process(target=setup, args=(url, args.workers, args.doctors))
+    process.start()
+    process.join()
+    doctor_ids = list(range(1, args.doctors + 1))
+    start, stop = multiprocessing.Event(), multiprocessing.Event()
+    results = multiprocessing.Queue()
+    patients = [multiprocessing.Process(target=patient_worker, args=(url, i, args.admissions, doctor_ids, start, results)) for i in range(args.workers)]
+    doctors = [multiprocessing.Process(target=doctor_worker, args=(url, doctor_id, start, stop, results)) for doctor_id in doctor_ids]
+    for process in patients + doctors:
+        process.start()
+    time.sleep(1)  # let every worker import the app before starting the clock
+    started = time.perf_counter()
+    start.set()
+    admitted, accepted, errors = {}, 0, 0
+    for _ in patients:
+        _, counts, failed = results.get()
+        errors += failed
+        for doctor_id, count in counts.items():
+            admitted[doctor_id] = admitted.get(doctor_id, 0) + count
+    elapsed = time.perf_counter() - started
+    stop.set()
+    for _ in doctors:
+        _, counts, failed = results.get()
+        errors += failed
+        accepted += sum(counts.values())
+    for process in patients + doctors:
+        process.join()
+    print(f"{sum(admitted.values())} admissions, {accepted} accepted in {elapsed:.2f}s, {errors} failed operations")
+    problems = verify(url, admitted)
+    for problem in problems:
+        print('FAIL ' + problem)
+    print('OK' if not problems and not errors else 'FAILED')
+    sys.exit(1 if problems or errors else 0)
@@ -0,0 +1,53 @@
+from datetime import datetime, timedelta
+
+import archive_data
+from flask_app import app, User, WaitingRoom, Message, ArchivedConsultation, ArchivedMessage
+
+
+def test_archived_ids_are_not_handed_out_again(fresh_db):
+    # Archive the newest consultation and message, add new ones, archive those too
+    db = fresh_db
+    old = datetime.utcnow() - timedelta(days=400)
+    with app.app_context():
+        doctor = User(username='arch_doc', password='x', role='doctor')
+        patient = User(username='arch_pac', password='x', role='patient')
+        db.session.add_all([doctor, patient])
+        db.session.commit()
+        archived = []
+        for _ in range(2):
+            waiting = WaitingRoom(patient_id=patient.id, doctor_id=doctor.id, symptoms='Tos', status='completed', created_at=old, end_time=old)
+            message = Message(sender_id=patient.id, receiver_id=doctor.id, content='Hola', read=True, timestamp=old)
+            db.session.add_all([waiting, message])
+            db.session.commit()
+            archived.append((waiting.id, message.id))
+            archive_data.archive_consultations([waiting.id])
+            archive_data.archive_messages([message.id])
+            db.session.commit()
+        (first_waiting, first_message), (second_waiting, second_message) = archived
+        assert second_waiting > first_waiting
+        assert second_message > first_message
+        assert sorted(row.id for row in ArchivedConsultation.query) == [first_waiting, second_waiting]
+        assert sorted(row.id for row in ArchivedMessage.query) == [first_message, second_message]
+
+
+def test_search_tells_archived_rows_from_live_ones_with_the_same_id(fresh_db):
+    # Databases from before the ids were kept unique may have a live row with an archived row's id
+    db = fresh_db
+    with app.app_context():
+        doctor = User(username='arch_doc', password='x', role='doctor')
+        patient = User(username='arch_pac', password='x', role='patient')
+        db.session.add_all([doctor, patient])
+        db.session.commit()
+        doctor_id = doctor.id
+        db.session.add(ArchivedConsultation(id=1, patient_id=patient.id, doctor_id=doctor.id, symptoms='fiebre vieja', status='completed'))
+        db.session.add(WaitingRoom(id=1, patient_id=patient.id, doctor_id=doctor.id, symptoms='fiebre nueva', status='completed'))
+        db.session.commit()
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(doctor_id)
+        session['_fresh'] = True
+    items = client.get('/api/search?q=fiebre&kind=symptoms').get_json()['items']
+    assert sorted((item['kind'], item['id'], item['archived'], item['snippet']) for item in items) == [
+        ('symptoms', 1, False, '[fiebre] nueva'),
+        ('symptoms', 1, True, '[fiebre] vieja'),
+    ]
@@ -0,0 +1,9 @@
+import check_query_plans
+
+
+def test_routes_answer_and_use_indexes(fresh_db):
+    # Every route answers 2xx/3xx and none of its queries is planned as a table scan
+    statements, errors, failures = check_query_plans.check()
+    assert statements
+    assert errors == []
+    assert [(route, statement) for route, statement, _ in failures] == []
@@ -0,0 +1,89 @@
+import threading
+
+import pytest
+from sqlalchemy.exc import IntegrityError
+
+from flask_app import app, User, WaitingRoom, queue_ordering, PENDING, ACTIVE
+
+
+def add_users(db, patients):
+    doctor = User(username='queue_doc', password='x', role='doctor', on_shift=True)
+    users = [User(username=f'queue_pac{i}', password='x', role='patient') for i in range(patients)]
+    db.session.add_all([doctor] + users)
+    db.session.commit()
+    return doctor.id, [user.id for user in users]
+
+
+def keys(doctor_id, statuses):
+    rows = WaitingRoom.query.filter(WaitingRoom.doctor_id == doctor_id, WaitingRoom.status.in_(statuses)).order_by(WaitingRoom.queue_order)
+    return [(row.id, row.queue_order) for row in rows]
+
+
+def test_concurrent_admits_take_unique_keys(fresh_db):
+    with app.app_context():
+        doctor_id, patient_ids = add_users(fresh_db, 8)
+    start, errors = threading.Barrier(len(patient_ids)), []
+
+    def admit(patient_id):
+        with app.app_context():
+            start.wait()
+            try:
+                for i in range(10):
+                    queue_ordering.admit(patient_id, doctor_id, f'Sintoma {i}')
+            except Exception as e:
+                errors.append(e)
+
+    threads = [threading.Thread(target=admit, args=(patient_id,)) for patient_id in patient_ids]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    with app.app_context():
+        queue = keys(doctor_id, PENDING)
+    assert len(queue) == 80
+    assert len({key for _, key in queue}) == 80
+
+
+def test_unique_index_rejects_a_taken_key(fresh_db):
+    with app.app_context():
+        doctor_id, (patient_id,) = add_users(fresh_db, 1)
+        queue_ordering.admit(patient_id, doctor_id, 'Tos')
+        (_, key), = keys(doctor_id, PENDING)
+        fresh_db.session.add(WaitingRoom(patient_id=patient_id, doctor_id=doctor_id, symptoms='Fiebre', status='pending', queue_order=key))
+        with pytest.raises(IntegrityError):
+            fresh_db.session.commit()
+        fresh_db.session.rollback()
+
+
+def test_reorder_past_the_limit_renumbers(fresh_db, monkeypatch):
+    gap = app.config['QUEUE_ORDER_GAP']
+    monkeypatch.setitem(app.config, 'QUEUE_ORDER_MAX', 20 * gap)
+    with app.app_context():
+        doctor_id, patient_ids = add_users(fresh_db, 4)
+        for patient_id in patient_ids:
+            queue_ordering.admit(patient_id, doctor_id, 'Tos')
+        highest = []
+        for _ in range(10):
+            order = [waiting_id for waiting_id, _ in reversed(keys(doctor_id, PENDING))]
+            queue_ordering.reorder(doctor_id, order)
+            fresh_db.session.commit()
+            queue = keys(doctor_id, PENDING)
+            assert [waiting_id for waiting_id, _ in queue] == order
+            highest.append(queue[-1][1])
+        assert max(highest) <= 20 * gap
+        assert min(highest) == 4 * gap  # renumbered back to GAP, 2*GAP, ...
+
+
+def test_a_request_is_accepted_only_once(fresh_db):
+    with app.app_context():
+        doctor_id, patient_ids = add_users(fresh_db, 2)
+        for patient_id in patient_ids:
+            queue_ordering.admit(patient_id, doctor_id, 'Tos')
+        (first, _), (second, _) = keys(doctor_id, PENDING)
+        assert queue_ordering.accept(first, doctor_id, patient_ids[0])
+        assert not queue_ordering.accept(first, doctor_id, patient_ids[0])
+        assert queue_ordering.accept(second, doctor_id, patient_ids[1])
+        active = keys(doctor_id, ACTIVE)
+    assert [waiting_id for waiting_id, _ in active] == [first, second]
+    assert len({key for _, key in active}) == 2